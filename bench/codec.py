@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# serialize/deserialize throughput on a large nested tuple, against the JSON
+# route through as_py
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import larkcodec
+from core import Val, Tuple, as_py, as_lark
+
+def record(i):
+    return Tuple([Val('int', i), Val('float', i * 0.5), Val('string', 'item{0}'.format(i))], named={
+        'id': Val('int', i * 7919),
+        'tags': Tuple([Val('string', 'a'), Val('string', 'b'), Val('int', -i)]),
+        'ok': Val('bool', i % 2 == 0),
+    })
+
+# as_lark only wraps decoded JSON in views that box members on access, so
+# build the values out the way deserialize does
+def materialize(v):
+    if isinstance(v, Tuple):
+        return Tuple([materialize(x) for x in v.iterate()],
+                named={k: materialize(x) for k, x in v.named.items()})
+    return v
+
+def count(v):
+    if isinstance(v, Tuple):
+        return 1 + sum(count(x) for x in v.iterate()) + sum(count(x) for x in v.named.values())
+    return 1
+
+def best_of(fn, n):
+    times = []
+    for i in range(n):
+        start = time.time()
+        result = fn()
+        times.append(time.time() - start)
+    return min(times), result
+
+# as_py keeps only the named members of a tuple that has both, so the JSON
+# side carries fewer values; compare values/s as well as bytes/s
+def report(name, seconds, size, values):
+    print '{0:20s} {1:8.3f}s {2:8.1f} MB/s {3:8.0f} kvalues/s'.format(
+            name, seconds, size / seconds / 1e6, values / seconds / 1e3)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    v = Tuple([record(i) for i in range(n)])
+    values = count(v)
+    t, data = best_of(lambda: larkcodec.dumps(v), repeat)
+    report('serialize', t, len(data), values)
+    t, _ = best_of(lambda: larkcodec.loads(memoryview(data)), repeat)
+    report('deserialize', t, len(data), values)
+    t, text = best_of(lambda: json.dumps(as_py(v)), repeat)
+    json_values = count(as_lark(json.loads(text)))
+    report('json.dumps(as_py)', t, len(text), json_values)
+    t, _ = best_of(lambda: materialize(as_lark(json.loads(text))), repeat)
+    report('as_lark(json.loads)', t, len(text), json_values)
+    print 'size: serialize {0} bytes for {1} values, json {2} bytes for {3} values'.format(
+            len(data), values, len(text), json_values)
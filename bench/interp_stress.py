@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# runs many scripts at once, each on its own Interpreter in a thread pool,
+# and checks every script's output only shows its own globals and externs
+import os
+import sys
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lark
+
+script = '''extern """
+tag = {i}
+"""
+x = {i}
+fib = [n]{{
+    if n < 2
+        n
+    else
+        fib[n-1] + fib[n-2]
+    end
+}}
+i = 0
+total = 0
+loop i < 200
+    total += x
+    i += 1
+end
+print[x]
+print[fib[{n}]]
+print[total]
+print[extern "tag"]
+'''
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+def expected(i):
+    return '{0}\n{1}\n{2}\n{0}\n'.format(i, fib(10 + i % 5), 200 * i)
+
+def run(i):
+    out = StringIO()
+    interp = lark.Interpreter(out=out)
+    interp.run(script.format(i=i, n=10 + i % 5))
+    interp.close()
+    return out.getvalue()
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    # switch threads often so the scripts interleave as much as possible
+    sys.setcheckinterval(10)
+    pool = ThreadPool(workers)
+    try:
+        outputs = pool.map(run, range(n))
+    finally:
+        pool.close()
+        pool.join()
+    bad = [i for i, out in enumerate(outputs) if out != expected(i)]
+    for i in bad[:5]:
+        print 'script {0}: expected {1!r}, got {2!r}'.format(i, expected(i), outputs[i])
+    print '{0} scripts on {1} threads, {2} with mixed output'.format(n, workers, len(bad))
+    sys.exit(1 if bad else 0)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# cold start of a script that imports several large modules but only uses
+# one helper from one of them, with and without --lazy-imports
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench_dir)
+from run import write_large_module
+
+lark = os.path.join(bench_dir, '..', 'lark.py')
+
+def best_of(args, cwd, n):
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for i in range(n):
+            start = time.time()
+            subprocess.check_call([sys.executable, lark] + args, cwd=cwd, stdout=devnull)
+            times.append(time.time() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    workdir = tempfile.mkdtemp()
+    try:
+        for i in range(modules):
+            sub = os.path.join(workdir, 'm{0}'.format(i))
+            os.mkdir(sub)
+            write_large_module(sub)
+        with open(os.path.join(workdir, 'main.lk'), 'wb') as f:
+            for i in range(modules):
+                f.write('import m{0}::large as m{0}\n'.format(i))
+            f.write('print[m0::f3[1]]\n')
+        # first runs write the parse caches, so both modes time execution
+        best_of(['main.lk'], workdir, 1)
+        eager = best_of(['main.lk'], workdir, 5)
+        lazy = best_of(['--lazy-imports', 'main.lk'], workdir, 5)
+        print 'eager      {0:.3f}s'.format(eager)
+        print 'lazy       {0:.3f}s'.format(lazy)
+        print 'speedup    {0:.2f}x'.format(eager / lazy)
+    finally:
+        shutil.rmtree(workdir)
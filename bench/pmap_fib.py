@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# times a fib workload through a sequential lark loop and through pmap
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lark import Interpreter
+
+setup = '''
+fib = [n]{
+    if n < 2
+        n
+    else
+        fib[n-1] + fib[n-2]
+    end
+}
+xs = (18, 18, 18, 18, 18, 18, 18, 18)
+'''
+
+sequential = '''
+out = (fib[xs.0],)
+i = 1
+loop i < len[xs]
+    out = push[out, fib[xs.(i)]]
+    i += 1
+end
+out
+'''
+
+def timed(interp, source):
+    start = time.time()
+    result = interp.run(source)
+    return time.time() - start, result
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    interp = Interpreter()
+    interp.run(setup)
+    seq_time, seq_result = timed(interp, sequential)
+    par_time, par_result = timed(interp, 'pmap[^fib, xs, {0}]'.format(workers or 'nil'))
+    assert str(seq_result) == str(par_result)
+    print 'sequential {0:.3f}s'.format(seq_time)
+    print 'pmap       {0:.3f}s'.format(par_time)
+    print 'speedup    {0:.2f}x'.format(seq_time / par_time)
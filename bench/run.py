@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Runs the bench/*.lk programs, each in its own process, and reports ops/sec,
+# peak RSS and Mem slot counts as JSON. With --baseline, compares against a
+# stored result and exits nonzero on regressions beyond --threshold.
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..'))
+
+def benchmarks():
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(bench_dir)
+            if name.endswith('.lk'))
+
+def ops_count(path):
+    with open(path, 'rb') as f:
+        m = re.match(r'#\s*ops:\s*(\d+)', f.readline())
+    return int(m.group(1)) if m else 1
+
+def write_large_module(dirname, n=300):
+    with open(os.path.join(dirname, 'large.lk'), 'wb') as f:
+        for i in range(n):
+            f.write('f{0} = [x]{{ x + {0} }}\n'.format(i))
+            f.write('v{0} = (a: {0}, b: "value {0}", c: (1, 2, 3))\n'.format(i))
+        for i in range(n // 10):
+            f.write('namespace ns{0} {{\n    g = [x]{{ x * {0} }}\n}}\n'.format(i))
+
+def run_one(name, repeat):
+    from lark import Interpreter
+
+    path = os.path.join(bench_dir, name + '.lk')
+    workdir = tempfile.mkdtemp()
+    write_large_module(workdir)
+    os.chdir(workdir)
+    devnull = open(os.devnull, 'wb')
+    try:
+        # warm up the parse cache and the interpreter
+        Interpreter(out=devnull).run_file(path)
+        times = []
+        for _ in range(repeat):
+            interp = Interpreter(out=devnull)
+            start = time.time()
+            interp.run_file(path)
+            times.append(time.time() - start)
+        memory = interp.root.memory
+    finally:
+        os.chdir(bench_dir)
+        shutil.rmtree(workdir)
+    times.sort()
+    median = times[len(times) // 2]
+    return {
+        'ops': ops_count(path),
+        'seconds': median,
+        'ops_per_sec': ops_count(path) / median if median > 0 else 0.0,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'mem_live_slots': len(memory.slots),
+        'mem_allocated': memory.last,
+    }
+
+def run_all(names, repeat):
+    results = {}
+    for name in names:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+            '--worker', name, '--repeat', str(repeat)])
+        results[name] = json.loads(out)
+        sys.stderr.write('{0:10s} {1:12.1f} ops/sec\n'.format(name, results[name]['ops_per_sec']))
+    return {'python': sys.version.split()[0], 'benchmarks': results}
+
+# (benchmark, metric, baseline, current, relative change) for every metric
+# that got worse by more than threshold
+def regressions(baseline, current, threshold):
+    found = []
+    for name, cur in current['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        checks = [
+            ('ops_per_sec', base['ops_per_sec'] - cur['ops_per_sec']),
+            ('peak_rss_kb', cur['peak_rss_kb'] - base['peak_rss_kb']),
+            ('mem_live_slots', cur['mem_live_slots'] - base['mem_live_slots']),
+        ]
+        for metric, worse_by in checks:
+            if base[metric] and float(worse_by) / base[metric] > threshold:
+                found.append((name, metric, base[metric], cur[metric], float(worse_by) / base[metric]))
+    return found
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('names', nargs='*', help='benchmarks to run (default all)')
+    argparser.add_argument('--repeat', type=int, default=5)
+    argparser.add_argument('--output', metavar='FILE', help='write results JSON to FILE')
+    argparser.add_argument('--baseline', metavar='FILE', help='compare against results in FILE')
+    argparser.add_argument('--threshold', type=float, default=0.10,
+            help='relative change that counts as a regression (default 0.10)')
+    argparser.add_argument('--worker', metavar='NAME', help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.worker:
+        print json.dumps(run_one(args.worker, args.repeat))
+        sys.exit(0)
+
+    results = run_all(args.names or benchmarks(), args.repeat)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(text + '\n')
+    else:
+        print text
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+        found = regressions(baseline, results, args.threshold)
+        for name, metric, base, cur, change in found:
+            sys.stderr.write('REGRESSION {0} {1}: {2:.1f} -> {3:.1f} ({4:+.1%})\n'.format(
+                name, metric, base, cur, change))
+        sys.exit(1 if found else 0)
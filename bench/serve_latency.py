@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# compares per-request latency of lark.py --serve against starting lark.py
+# once per script
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+lark = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lark.py')
+
+script = '''
+fib = [n]{
+    if n < 2
+        n
+    else
+        fib[n-1] + fib[n-2]
+    end
+}
+print[fib[n]]
+'''
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+def report(name, times):
+    print '{0:12s} mean {1:8.2f}ms  p50 {2:8.2f}ms  p99 {3:8.2f}ms'.format(
+        name, 1000 * sum(times) / len(times), 1000 * percentile(times, 0.5), 1000 * percentile(times, 0.99))
+
+def per_process(path, n):
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for i in range(n):
+            start = time.time()
+            subprocess.check_call([sys.executable, lark, path], stdout=devnull)
+            times.append(time.time() - start)
+    return times
+
+def served(path, n):
+    server = subprocess.Popen([sys.executable, lark, '--serve'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    times = []
+    try:
+        for i in range(n):
+            start = time.time()
+            server.stdin.write(json.dumps({'id': i, 'path': path}) + '\n')
+            server.stdin.flush()
+            response = json.loads(server.stdout.readline())
+            times.append(time.time() - start)
+            assert response['ok'], response
+    finally:
+        server.stdin.close()
+        server.wait()
+    return times
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    fd, path = tempfile.mkstemp(suffix='.lk')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write('n = 12\n' + script)
+        report('per-process', per_process(path, n))
+        report('served', served(path, n))
+    finally:
+        os.unlink(path)
+        if os.path.exists(path + 'c'):
+            os.unlink(path + 'c')
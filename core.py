@@ -1,3 +1,11 @@
+import sys
+import time
+import mmap
+import types
+import Queue
+import itertools
+import threading
+
 class LarkException(Exception): pass
 class SyntaxError(LarkException): pass
 class LarkReturn(LarkException): pass
@@ -45,10 +53,22 @@ class Val(object):
     def cleanup(self):
         pass
 
+    def iterate(self):
+        if self.type == 'string':
+            return (Val('string', c) for c in self.data)
+        raise LarkException("Cannot iterate over value of type '{0}'".format(self.type))
+
     # primitives should not copy
     def copy(self):
         return self
 
+    # keep nil/true/false singletons across pickling
+    def __reduce_ex__(self, proto):
+        for name in ('nil', 'true', 'false'):
+            if self is globals().get(name):
+                return name
+        return super(Val, self).__reduce_ex__(proto)
+
 nil = Val('niltype', None)
 nil.as_str = 'nil'
 true = Val('bool', True)
@@ -57,11 +77,26 @@ false = Val('bool', False)
 false.as_str = 'false'
 
 class ParamVal(Val):
-    def __init__(self, v=None, params=[], cl=None, refs=[]):
+    generator = False
+    # binding name and (file, line) of the pval literal, for diagnostics,
+    # and the span table of the program it came from, kept alive with it
+    name = None
+    location = None
+    spans = None
+    # set from lark.py to a larkspec.Specializer, which picks the body to run
+    specializer = None
+    calls = 0
+    spec = None
+    observed = None
+
+    def __init__(self, v=None, params=[], cl=None, refs=[], prog=None, names=[]):
         self.type = 'pval'
         self.data = v
         self.params = params
         self.cl = cl
+        # body and free variable names, kept so the pval can be rebuilt elsewhere
+        self.prog = prog
+        self.names = names
         str_params = []
         self.min_args = len(self.params)
         for i, p in enumerate(self.params):
@@ -84,8 +119,31 @@ class ParamVal(Val):
                 raise LarkException("Wrong number of parameters: expected at least {0}, got {1}".format(self.min_args, len(args)))
             else:
                 raise LarkException("Wrong number of parameters: expected {0}, got {1}".format(len(self.params), len(args)))
+        self.calls += 1
+        ex = self.bind(args)
+        if self.generator:
+            return Seq(Generator(self.data, ex))
+        body = self.data if self.specializer is None else self.specializer.select(self, args)
+        ret = body(ex)
+        ex.cleanup()
+        return ret
+
+    # runs the body in an Env already bound to args; this is Caller's way in,
+    # so profilers hook it alongside __call__
+    def run_in(self, ex, args):
+        self.calls += 1
+        body = self.data if self.specializer is None else self.specializer.select(self, args)
+        return body(ex)
+
+    # compiled specializations hold closures, so images leave them out
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('spec', None)
+        state.pop('observed', None)
+        return state
+
+    def bind(self, args):
         ex = Env(parent=self.cl)
-        refs = []
         for i,k in enumerate(self.params):
             # should refs be allowed as v for non-ref k?
             if i >= len(args):
@@ -100,9 +158,7 @@ class ParamVal(Val):
                     ex.vars[k[1]] = v
                 else:
                     ex.new_assign(k[1], v.copy())
-        ret = self.data(ex)
-        ex.cleanup()
-        return ret
+        return ex
 
     def cleanup(self):
         for r in self.refs:
@@ -110,6 +166,73 @@ class ParamVal(Val):
 
     # needs copy? should closures copy? unclear
 
+class Builtin(Val):
+    # python-implemented pval, called directly with the evaluated arguments;
+    # copy_args gives it the same argument copying as a ParamVal call
+    def __init__(self, fn, name, params=[], defaults=(), copy_args=False):
+        self.type = 'pval'
+        self.data = fn
+        self.name = name
+        self.params = params
+        self.min_args = len(params) - len(defaults)
+        self.copy_args = copy_args
+        self.as_str = "pval[{0}]".format(",".join(params))
+
+    def __call__(self, *args):
+        if len(args) < self.min_args:
+            if len(self.params) != self.min_args:
+                raise LarkException("Wrong number of parameters: expected at least {0}, got {1}".format(self.min_args, len(args)))
+            else:
+                raise LarkException("Wrong number of parameters: expected {0}, got {1}".format(len(self.params), len(args)))
+        args = args[:len(self.params)]
+        if self.copy_args:
+            args = [v.copy() for v in args]
+        return self.data(*args)
+
+class Caller(object):
+    # calls one pval repeatedly, rebinding the parameters of a single Env
+    # instead of building a new one each time. The Env is only kept while the
+    # body neither defines locals nor captures its parameters in a closure.
+    def __init__(self, pv):
+        self.pv = pv
+        self.ex = None
+        self.slots = None
+        self.fast = (isinstance(pv, ParamVal) and not pv.generator
+                and all(p[0] == 'param' for p in pv.params))
+
+    def __call__(self, *args):
+        pv = self.pv
+        if not self.fast or len(args) != len(pv.params):
+            try:
+                return pv(*args)
+            except LarkReturn as e:
+                return e.value
+        ex = self.ex
+        self.ex = None
+        if ex is None:
+            ex = pv.bind(args)
+            self.slots = [ex.memory[ex.vars[p[1]].addr] for p in pv.params]
+        else:
+            for var, v in zip(self.slots, args):
+                var.val = v.copy()
+        try:
+            ret = pv.run_in(ex, args)
+        except LarkReturn as e:
+            ret = e.value
+        except:
+            ex.cleanup()
+            raise
+        if len(ex.vars) == len(self.slots) and not ex.namespaces and all(var.refs == 1 for var in self.slots):
+            self.ex = ex
+        else:
+            ex.cleanup()
+        return ret
+
+    def close(self):
+        if self.ex is not None:
+            self.ex.cleanup()
+            self.ex = None
+
 class PyVal(Val):
     def __init__(self, obj):
         self.type = 'py'
@@ -160,6 +283,12 @@ class PyVal(Val):
             return as_lark(self.data.__call__(*map(as_py, args)))
         return self
 
+    def iterate(self):
+        try:
+            return itertools.imap(as_lark, iter(self.data))
+        except TypeError:
+            raise LarkException("Cannot iterate over python value {0}".format(repr(self.data)))
+
     def __str__(self):
         return str(self.data)
 
@@ -170,8 +299,208 @@ class PyVal(Val):
         return self.data == other.data
 
 
+class Buffer(Val):
+    # zero-copy view over anything exposing the buffer protocol
+    def __init__(self, obj):
+        self.type = 'bytes'
+        try:
+            self.data = memoryview(obj)
+        except TypeError:
+            # old-style buffer objects, e.g. mmap on python 2
+            self.data = buffer(obj)
+        self.as_str = 'bytes[{0}]'.format(len(self.data))
+
+    def __repr__(self):
+        return self.as_str
+
+    def getmember(self, a):
+        if isinstance(a, Tuple):
+            # b.((start, end)) slices without copying; nil leaves an end open
+            if a.length() != 2:
+                raise LarkException("Bytes slice must be a (start, end) tuple.")
+            start, end = [as_py(x) for x in a.data]
+            start, end, _ = slice(start, end).indices(len(self.data))
+            return self.slice(start, end)
+        if isinstance(a, Val):
+            a = a.data
+        if isinstance(a, int):
+            try:
+                x = self.data[a]
+            except IndexError:
+                raise LarkException("Dot-access index for bytes is out of range: {0}".format(a))
+            return Val('int', ord(x)) if len(x) == 1 else Val('string', x)
+        raise LarkException("Cannot dot-access bytes with value {0}".format(repr(a)))
+
+    def slice(self, start, end):
+        end = max(start, end)
+        if isinstance(self.data, memoryview):
+            return Buffer(self.data[start:end])
+        return Buffer(buffer(self.data, start, end - start))
+
+    def setmember(self, a, x):
+        raise LarkException("Bytes are read-only.")
+
+    def iterate(self):
+        return (Val('int', ord(c)) for c in self.data)
+
+    def length(self):
+        return len(self.data)
+
+class LarkGeneratorExit(LarkException): pass
+
+current = threading.local()
+
+def yield_value(v):
+    channel = getattr(current, 'channel', None)
+    if channel is None:
+        raise LarkException("Yield outside of generator.")
+    channel.put(('value', v))
+    if channel.resume.get() == 'close':
+        raise LarkGeneratorExit("Generator closed.")
+    return nil
+
+class Channel(object):
+    def __init__(self):
+        self.values = Queue.Queue(1)
+        self.resume = Queue.Queue(1)
+
+    def put(self, item):
+        self.values.put(item)
+
+def run_generator(fn, env, channel):
+    current.channel = channel
+    try:
+        fn(env)
+        channel.put(('done', None))
+    except (LarkReturn, LarkGeneratorExit):
+        channel.put(('done', None))
+    except Exception:
+        channel.put(('error', sys.exc_info()))
+    finally:
+        env.cleanup()
+
+class Generator(object):
+    # runs a generator pval body on its own thread, handing values over one
+    # at a time, so the body only runs as far as the consumer has pulled
+    def __init__(self, fn, env):
+        self.fn = fn
+        self.env = env
+        self.channel = Channel()
+        self.started = False
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration
+        if not self.started:
+            self.started = True
+            t = threading.Thread(target=run_generator, args=(self.fn, self.env, self.channel))
+            t.daemon = True
+            t.start()
+        else:
+            self.channel.resume.put('next')
+        kind, v = self.channel.values.get()
+        if kind == 'value':
+            return v
+        self.finished = True
+        if kind == 'error':
+            raise v[0], v[1], v[2]
+        raise StopIteration
+
+    def close(self):
+        if self.started and not self.finished:
+            self.finished = True
+            self.channel.resume.put('close')
+            self.channel.values.get()
+
+    def __del__(self):
+        self.close()
+
+class Seq(Val):
+    # lazy, single pass sequence of lark values over a python iterator
+    def __init__(self, it):
+        self.type = 'seq'
+        self.data = it
+        self.as_str = 'seq'
+
+    def __repr__(self):
+        return self.as_str
+
+    def iterate(self):
+        return self.data
+
+class Range(Val):
+    # immutable integer range; iterating it makes each int on demand
+    def __init__(self, start, stop, step=1):
+        if step == 0:
+            raise LarkException("Range step cannot be zero.")
+        self.type = 'range'
+        self.data = xrange(start, stop, step)
+        self.as_str = 'range({0}, {1}, {2})'.format(start, stop, step)
+
+    def getmember(self, a):
+        if isinstance(a, Val):
+            a = a.data
+        if not isinstance(a, int):
+            raise LarkException("Cannot dot-access range with value {0}".format(repr(a)))
+        try:
+            return Val('int', self.data[a])
+        except IndexError:
+            raise LarkException("Dot-access index for range is out of range: {0}".format(a))
+
+    def length(self):
+        return len(self.data)
+
+    def iterate(self):
+        return (Val('int', i) for i in self.data)
+
+class Task(Val):
+    # runs a call on its own thread; blocking python calls inside it release
+    # the GIL, so waiting tasks overlap
+    def __init__(self, fn, args=()):
+        self.type = 'task'
+        self.as_str = 'task'
+        self.result = None
+        self.error = None
+        self.data = threading.Thread(target=self.run, args=(fn, args))
+        self.data.daemon = True
+        self.data.start()
+
+    def run(self, fn, args):
+        try:
+            self.result = fn(*args)
+        except LarkReturn as e:
+            self.result = e.value
+        except Exception:
+            self.error = sys.exc_info()
+
+    def wait(self):
+        self.data.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+# exact types converted without walking the isinstance checks below
+scalar_types = {
+    type(None): lambda obj: nil,
+    bool: lambda obj: true if obj else false,
+    int: lambda obj: Val('int', obj),
+    long: lambda obj: Val('int', obj),
+    float: lambda obj: Val('float', obj),
+    str: lambda obj: Val('string', obj),
+    unicode: lambda obj: Val('string', obj),
+}
+
 def as_lark(obj):
-    if obj is None:
+    convert = scalar_types.get(type(obj))
+    if convert is not None:
+        return convert(obj)
+    elif isinstance(obj, (Val, Ref)):
+        return obj
+    elif obj is None:
         return nil
     elif isinstance(obj, bool):
         return true if obj else false
@@ -181,17 +510,32 @@ def as_lark(obj):
         return Val('int', obj)
     elif isinstance(obj, float):
         return Val('float', obj)
-    elif isinstance(obj, tuple):
-        return Tuple([as_lark(o) for o in obj])
-    elif isinstance(obj, list):
-        return Tuple([as_lark(o) for o in obj])
+    elif isinstance(obj, (tuple, list)):
+        return ListView(obj)
     elif isinstance(obj, dict):
-        return Tuple(named={k:as_lark(v) for k,v in obj.items()})
-    else:
+        return DictView(obj)
+    elif isinstance(obj, (set, frozenset)):
+        return Set(as_lark(x) for x in obj)
+    elif isinstance(obj, types.GeneratorType):
+        return Seq(itertools.imap(as_lark, obj))
+    elif isinstance(obj, (memoryview, bytearray, buffer, mmap.mmap)):
+        return Buffer(obj)
+    try:
+        memoryview(obj)
+    except TypeError:
         return PyVal(obj)
+    return Buffer(obj)
 
 def as_py(val):
-    if isinstance(val, Tuple):
+    if isinstance(val, (ListView, DictView)):
+        return val.obj
+    elif isinstance(val, Map):
+        return {py_key(k): as_py(v) for k, v in val.data.itervalues()}
+    elif isinstance(val, Set):
+        return set(py_key(k) for k in val.data.itervalues())
+    elif isinstance(val, Seq):
+        return itertools.imap(as_py, val.data)
+    elif isinstance(val, Tuple):
         if val.named:
             return {k:as_py(v) for k,v in val.named.items()}
         else:
@@ -233,6 +577,10 @@ class Tuple(Val):
     def labels(self):
         return Tuple([Val('string', x) for x in self.named.keys()])
 
+    # named-member check without building an exception, for operator lookup
+    def hasmember(self, a):
+        return a in self.named
+
     def setmember(self, a, x):
         if isinstance(a, Val):
             a = a.data
@@ -247,15 +595,290 @@ class Tuple(Val):
             raise LarkException("Cannot dot-access tuple with non-int member {0}".format(repr(a)))
         return x
 
+    # members are compared one at a time, so views aren't boxed up front
+    def __eq__(self, other):
+        if not isinstance(other, Tuple) or self.length() != other.length():
+            return False
+        for a, b in itertools.izip(self.iterate(), other.iterate()):
+            if not a == b:
+                return False
+        return self.named == other.named
+
+    def size(self):
+        return self.length() + len(self.named)
+
+    def append(self, x):
+        self.data.append(x)
+
+    def iterate(self):
+        return iter(self.data)
+
     def copy(self):
         d = [x.copy() for x in self.data]
         n = {k:v.copy() for k,v in self.named.items()}
         return Tuple(d, named=n)
 
+# lark values with a python equivalent are stored in views as python
+# objects; pvals, refs, seqs and the like are stored as they are
+def view_py(x):
+    if type(x) is Val or isinstance(x, (Tuple, Map, Set, PyVal, Buffer)):
+        return as_py(x)
+    return x
+
+def copy_py(obj):
+    # copies the containers a view exposes as tuples, shares everything else
+    if isinstance(obj, list):
+        return [copy_py(x) for x in obj]
+    elif isinstance(obj, tuple):
+        return tuple(copy_py(x) for x in obj)
+    elif isinstance(obj, dict):
+        return {k:copy_py(v) for k,v in obj.items()}
+    return obj
+
+# Views expose a python list/tuple or dict as a lark tuple without converting
+# it up front; members are boxed with as_lark only when accessed.
+class ListView(Tuple):
+    def __init__(self, obj):
+        self.type = 'tuple'
+        self.obj = obj
+
+    @property
+    def data(self):
+        return [as_lark(x) for x in self.obj]
+
+    @property
+    def named(self):
+        return {}
+
+    def getmember(self, a):
+        if isinstance(a, Val):
+            a = a.data
+        if isinstance(a, int):
+            try:
+                return as_lark(self.obj[a])
+            except IndexError:
+                raise LarkException("Dot-access index for tuple is out of range: {0}".format(a))
+        elif isinstance(a, basestring):
+            raise LarkException("Dot-access member '{0}' not in tuple".format(a))
+        else:
+            raise LarkException("Cannot dot-access tuple with member {0}".format(repr(a)))
+
+    def length(self):
+        return len(self.obj)
+
+    def iterate(self):
+        return itertools.imap(as_lark, self.obj)
+
+    def labels(self):
+        return Tuple([])
+
+    def hasmember(self, a):
+        return False
+
+    def setmember(self, a, x):
+        if isinstance(a, Val):
+            a = a.data
+        if not isinstance(a, int):
+            raise LarkException("Cannot dot-access tuple with non-int member {0}".format(repr(a)))
+        obj = self.writable()
+        try:
+            obj[a] = view_py(x)
+        except IndexError:
+            raise LarkException("Dot-access index for tuple is out of range: {0}".format(a))
+        return x
+
+    def append(self, x):
+        self.writable().append(view_py(x))
+
+    # a view over a python tuple switches to a list of its own when written
+    def writable(self):
+        if isinstance(self.obj, tuple):
+            self.obj = list(self.obj)
+        return self.obj
+
+    def copy(self):
+        return ListView(copy_py(self.obj))
+
+class DictView(Tuple):
+    def __init__(self, obj):
+        self.type = 'tuple'
+        self.obj = obj
+
+    @property
+    def data(self):
+        return []
+
+    @property
+    def named(self):
+        return {str(k):as_lark(v) for k,v in self.obj.items()}
+
+    def getmember(self, a):
+        if isinstance(a, Val):
+            a = a.data
+        if isinstance(a, (int, basestring)):
+            try:
+                return as_lark(self.obj[self.key(a)])
+            except KeyError:
+                raise LarkException("Dot-access member '{0}' not in tuple".format(a))
+        else:
+            raise LarkException("Cannot dot-access tuple with member {0}".format(repr(a)))
+
+    def length(self):
+        return 0
+
+    def size(self):
+        return len(self.obj)
+
+    def labels(self):
+        return Tuple([Val('string', str(k)) for k in self.obj.keys()])
+
+    def hasmember(self, a):
+        return self.key(a) in self.obj
+
+    # members are named str(key), as Tuple(named=) names them; the raw key is
+    # tried first so lookups by the python key stay direct
+    def key(self, a):
+        if a in self.obj or not isinstance(a, basestring):
+            return a
+        for k in self.obj:
+            if str(k) == a:
+                return k
+        return a
+
+    def setmember(self, a, x):
+        if isinstance(a, Val):
+            a = a.data
+        if not isinstance(a, (int, basestring)):
+            raise LarkException("Cannot dot-access tuple with member {0}".format(repr(a)))
+        self.obj[self.key(a)] = view_py(x)
+        return x
+
+    def append(self, x):
+        raise LarkException("Cannot push to python dict.")
+
+    def copy(self):
+        return DictView(copy_py(self.obj))
+
+# structural key for a lark value: values that compare equal get equal keys,
+# so tuples can index maps and sets by content
+def hash_key(v):
+    if isinstance(v, Tuple):
+        return ('tuple', tuple(hash_key(x) for x in v.iterate()),
+                tuple(sorted((k, hash_key(x)) for k, x in v.named.items())))
+    try:
+        hash(v.data)
+    except TypeError:
+        raise LarkException("Value of type '{0}' cannot be used as a key.".format(v.type))
+    return (v.type, v.data)
+
+# hashable python equivalent of a key, for as_py
+def py_key(v):
+    if isinstance(v, Tuple):
+        return tuple(py_key(x) for x in v.iterate()) + tuple(
+                sorted((k, py_key(x)) for k, x in v.named.items()))
+    return as_py(v)
+
+def key_val(a):
+    if isinstance(a, Val):
+        return a
+    return Val('string' if isinstance(a, basestring) else 'int', a)
+
+class Map(Val):
+    # hash map from any hashable lark value to a value; entries are stored
+    # as hash_key -> (key, value)
+    def __init__(self, items=()):
+        self.type = 'map'
+        self.data = {}
+        for k, v in items:
+            self.put(k, v)
+
+    def __str__(self):
+        return 'map({0})'.format(','.join('{0}:{1}'.format(k, v) for k, v in self.data.values()))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def has(self, k):
+        return hash_key(k) in self.data
+
+    def get(self, k, default=nil):
+        entry = self.data.get(hash_key(k))
+        return default if entry is None else entry[1]
+
+    def put(self, k, v):
+        # keys are copied so mutating a tuple afterwards can't desync its entry
+        self.data[hash_key(k)] = (k.copy(), v)
+
+    def remove(self, k):
+        self.data.pop(hash_key(k), None)
+
+    def getmember(self, a):
+        a = key_val(a)
+        entry = self.data.get(hash_key(a))
+        if entry is None:
+            raise LarkException("Key {0} not in map".format(repr(a)))
+        return entry[1]
+
+    def setmember(self, a, x):
+        self.put(key_val(a), x)
+        return x
+
+    def length(self):
+        return len(self.data)
+
+    def labels(self):
+        return Tuple([k for k, v in self.data.values()])
+
+    def items(self):
+        return self.data.itervalues()
+
+    def iterate(self):
+        return (k for k, v in self.data.itervalues())
+
+    def copy(self):
+        m = Map()
+        m.data = {h: (k, v.copy()) for h, (k, v) in self.data.items()}
+        return m
+
+class Set(Val):
+    # hash set of lark values, stored as hash_key -> value
+    def __init__(self, items=()):
+        self.type = 'set'
+        self.data = {}
+        for k in items:
+            self.put(k)
+
+    def __str__(self):
+        return 'set({0})'.format(','.join(str(k) for k in self.data.values()))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def has(self, k):
+        return hash_key(k) in self.data
+
+    def put(self, k):
+        self.data[hash_key(k)] = k.copy()
+
+    def remove(self, k):
+        self.data.pop(hash_key(k), None)
+
+    def length(self):
+        return len(self.data)
+
+    def iterate(self):
+        return self.data.itervalues()
+
+    def copy(self):
+        s = Set()
+        s.data = dict(self.data)
+        return s
+
 class Var(object):
-    def __init__(self, val=nil):
+    def __init__(self, val=nil, name=None):
         self.val = val
         self.refs = 1
+        self.name = name
 
     def __str__(self):
         return repr(self)
@@ -275,10 +898,13 @@ class Ref(object):
         return "ref({0}, {1})".format(self.name, self.addr)
 
 class Env(object):
-    def __init__(self, memory=None, parent=None):
+    def __init__(self, memory=None, parent=None, interp=None):
         self.memory = memory
         self.parent = parent
         self.namespaces = {}
+        self.interp = interp
+        if interp is None and parent is not None:
+            self.interp = parent.interp
         if memory is None:
             if parent is not None:
                 self.memory = parent.memory
@@ -306,7 +932,7 @@ class Env(object):
             raise LarkException("Variable '{0}' already defined in this scope.".format(name))
         r = Ref(name, self.memory.next_addr())
         self.vars[name] = r
-        self.memory[r.addr] = Var(nil)
+        self.memory[r.addr] = Var(nil, name)
         return r
 
     def getlocal_ormakeref(self, name):
@@ -316,8 +942,12 @@ class Env(object):
             r = self.makeref(name)
         return r
 
+    # slots are shared with spawned tasks and served requests on other
+    # threads, and += on a count isn't atomic
     def incref(self, ref):
-        self.memory[ref.addr].refs += 1
+        memory = self.memory
+        with memory.lock:
+            memory[ref.addr].refs += 1
 
     def get_ns(self, ns):
         if ns in self.namespaces:
@@ -337,12 +967,12 @@ class Env(object):
         return env
 
     def decref(self, ref):
-        n = self.memory[ref.addr].refs
-        n -= 1
-        if n > 0:
-            self.memory[ref.addr].refs = n
-        else:
-            del self.memory[ref.addr]
+        memory = self.memory
+        with memory.lock:
+            var = memory[ref.addr]
+            var.refs -= 1
+            if var.refs <= 0:
+                del memory[ref.addr]
 
     def new_assign(self, name, val):
         ref = self.makeref(name)
@@ -364,14 +994,113 @@ class Env(object):
         for n,r in self.vars.items():
             self.decref(r)
 
+class PyNamespace(Env):
+    # namespace over a python module; attributes are converted and bound on
+    # first lookup rather than at import time
+    def __init__(self, module, memory):
+        super(PyNamespace, self).__init__(memory=memory)
+        self.module = module
+
+    def getref(self, name):
+        if '::' in name:
+            return super(PyNamespace, self).getref(name)
+        r = self.vars.get(name, None)
+        if r is None:
+            try:
+                v = getattr(self.module, name)
+            except AttributeError:
+                raise LarkException("Could not find variable '{0}' in python module '{1}'.".format(name, self.module.__name__))
+            r = self.new_assign(name, as_lark(v))
+        return r
+
+    def get_ns(self, ns):
+        if ns not in self.namespaces:
+            v = getattr(self.module, ns, None)
+            if isinstance(v, types.ModuleType):
+                return self.set_ns(ns, PyNamespace(v, self.memory))
+        return super(PyNamespace, self).get_ns(ns)
+
+class LazyModule(object):
+    # a file imported lazily; env is set once the file has run
+    def __init__(self, path):
+        self.path = path
+        self.env = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+class LazyNamespace(Env):
+    # placeholder registered by a lazy import; the first lookup has the
+    # interpreter run the module, and everything after that goes to the
+    # namespace it resolved to
+    def __init__(self, parent, name, module, parts=()):
+        super(LazyNamespace, self).__init__(parent=parent)
+        self.name = name
+        self.module = module
+        self.parts = list(parts)
+        self.target = None
+
+    def force(self):
+        if self.target is None:
+            self.target = self.interp.load_namespace(self)
+            if self.parent.namespaces.get(self.name) is self:
+                self.parent.set_ns(self.name, self.target)
+        return self.target
+
+    def getref(self, name):
+        return self.force().getref(name)
+
+    def makeref(self, name):
+        return self.force().makeref(name)
+
+    def getlocal_ormakeref(self, name):
+        return self.force().getlocal_ormakeref(name)
+
+    def new_assign(self, name, val):
+        return self.force().new_assign(name, val)
+
+    def get_ns(self, ns):
+        return self.force().get_ns(ns)
+
+    def get_or_create_ns(self, ns):
+        return self.force().get_or_create_ns(ns)
+
+    def set_ns(self, ns, env):
+        return self.force().set_ns(ns, env)
+
 class Mem(object):
     def __init__(self):
         self.last = 0
         self.slots = {}
+        self.addrs = itertools.count()
+        self.frees = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    # itertools.count and locks can't be pickled; images restart the count
+    # after the last address
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['addrs']
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.addrs = itertools.count(self.last)
+        self.lock = threading.Lock()
 
+    # atomic under the GIL, so tasks on other threads never share an address
     def next_addr(self):
-        a = self.last
-        self.last += 1
+        a = next(self.addrs)
+        self.last = a + 1
         return a
 
     def __getitem__(self, key):
@@ -382,6 +1111,7 @@ class Mem(object):
 
     def __delitem__(self, key):
         self.slots.__delitem__(key)
+        self.frees += 1
 
     def __contains__(self, item):
         return self.slots.__contains__(item)
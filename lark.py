@@ -1,41 +1,91 @@
 #!/usr/bin/env python
 import os
 import sys
+import time
+import types
+import operator
+import itertools
+import cPickle as pickle
+from functools import partial
+from multiprocessing import Pool
 
-from larkparse import parse
+from larkparse import Parser, lookup
+from larkcache import parse_file, compile_all
+import larkio
+import larkmem
+import larkimage
+import larkspec
+import larkcodec
 from core import *
 
-root = Env(memory=Mem())
-extern_globals = {}
-extern_locals = {}
+builtins = []
 
-def larkfunction(fn):
-    name = fn.func_name.lstrip('_')
-    params = [('param', x) for x in fn.__code__.co_varnames[:fn.__code__.co_argcount]]
-    def wrapper(env):
-        return fn(*[env.retrieve_val(env.getref(p[1])) for p in params])
-    root.new_assign(name, ParamVal(wrapper, params=params, cl=root))
-    return wrapper
+# builtins declared with interp=True receive the owning Interpreter as their
+# first argument
+def larkfunction(fn=None, copy_args=False, interp=False):
+    if fn is None:
+        return lambda fn: larkfunction(fn, copy_args=copy_args, interp=interp)
+    builtins.append((fn, copy_args, interp))
+    return fn
 
-@larkfunction
-def _print(x):
-    print x
+# streams a value to write() piece by piece, producing the same text as
+# str() without building one string for a whole tuple
+def write_value(write, v):
+    if isinstance(v, Tuple):
+        write('(')
+        first = True
+        for x in v.iterate():
+            if not first:
+                write(',')
+            first = False
+            write_value(write, x)
+        for k, x in v.named.items():
+            if not first:
+                write(',')
+            first = False
+            write(k)
+            write(':')
+            write_value(write, x)
+        write(')')
+    else:
+        write(str(v))
+
+@larkfunction(interp=True)
+def _print(interp, x):
+    write_value(interp.out.write, x)
+    interp.out.write('\n')
+    return nil
+
+@larkfunction(interp=True)
+def _print_many(interp, t):
+    write = interp.out.write
+    for x in t.iterate():
+        write_value(write, x)
+        write('\n')
+    return nil
+
+@larkfunction(interp=True)
+def _flush(interp):
+    interp.out.flush()
     return nil
 
 @larkfunction
 def _len(v):
-    assert (v.type in ['string', 'tuple'])
+    assert (v.type in ['string', 'tuple', 'bytes', 'range', 'map', 'set'])
+    if v.type in ['tuple', 'bytes', 'range', 'map', 'set']:
+        return Val('int', v.length())
     return Val('int', len(v.data))
 
 @larkfunction
 def _size(v):
     assert (v.type == 'tuple')
-    return Val('int', len(v.data)+len(v.named))
+    return Val('int', v.size())
 
-@larkfunction
+# push returns the extended tuple without touching the caller's
+@larkfunction(copy_args=True)
 def _push(t, x):
     assert isinstance(t, Tuple)
-    t.data.append(x)
+    t.append(x)
     return t
 
 @larkfunction
@@ -45,11 +95,66 @@ def _keys(t):
 
 @larkfunction
 def _pairs(t):
+    if isinstance(t, Map):
+        return Tuple([Tuple([k, v]) for k, v in t.items()])
     assert isinstance(t, Tuple)
-    p = [Tuple([Val('int', i), v]) for i, v in enumerate(t.data)]
+    p = [Tuple([Val('int', i), v]) for i, v in enumerate(t.iterate())]
     p += [Tuple([Val('string', k), v]) for k, v in t.named.items()]
     return Tuple(p)
 
+# hashmap[] is empty; hashmap[src] takes (key, value) pairs from a tuple or
+# seq, named tuple members as string keys, or copies another map
+@larkfunction
+def _hashmap(src=nil):
+    if src == nil:
+        return Map()
+    elif isinstance(src, Map):
+        return src.copy()
+    m = Map()
+    for p in src.iterate():
+        if not isinstance(p, Tuple) or p.length() != 2:
+            raise LarkException("Expected a (key, value) pair, got {0}".format(repr(p)))
+        m.put(p.getmember(0), p.getmember(1))
+    if isinstance(src, Tuple):
+        for k, v in src.named.items():
+            m.put(Val('string', k), v)
+    return m
+
+@larkfunction
+def _set(src=nil):
+    if src == nil:
+        return Set()
+    return Set(src.iterate())
+
+@larkfunction
+def _has(c, k):
+    if isinstance(c, (Map, Set)):
+        return true if c.has(k) else false
+    elif isinstance(c, Tuple) and k.type == 'string':
+        return true if c.hasmember(k.data) else false
+    raise LarkException("Cannot check membership in value of type '{0}'".format(c.type))
+
+@larkfunction
+def _get(m, k, default=nil):
+    assert isinstance(m, Map)
+    return m.get(k, default)
+
+# put and remove change the map or set in place and return it
+@larkfunction
+def _put(c, k, v=nil):
+    if isinstance(c, Set):
+        c.put(k)
+    else:
+        assert isinstance(c, Map)
+        c.put(k, v)
+    return c
+
+@larkfunction
+def _remove(c, k):
+    assert isinstance(c, (Map, Set))
+    c.remove(k)
+    return c
+
 @larkfunction
 def _type(v):
     return Val('string', v.type)
@@ -64,15 +169,502 @@ def fn_dump(env):
     for k,v in curr.vars.items():
         names[v.addr] = k
     while curr.parent is not None:
-        curr = env.parent
+        curr = curr.parent
         for k,v in curr.vars.items():
             names[v.addr] = k
 
-    print '{{\n{0}\n}}'.format('\n'.join(
-        '\t{0:10s} => {1}'.format(names.get(k, str(k)), v) for k,v in env.memory.slots.items()
+    print >>env.interp.out, '{{\n{0}\n}}'.format('\n'.join(
+        '\t{0:10s} => {1}'.format(names.get(k, v.name or str(k)), v) for k,v in env.memory.slots.items()
     ))
     return nil
-root.new_assign("dump", ParamVal(fn_dump, cl=root))
+
+def int_tuple(d):
+    return Tuple([], named={str(k): Val('int', v) for k, v in d.items()})
+
+@larkfunction(interp=True)
+def _mem_stats(interp):
+    st = larkmem.stats(interp.root.memory)
+    return Tuple([], named={
+        'live': Val('int', st['live']),
+        'allocs': Val('int', st['allocs']),
+        'frees': Val('int', st['frees']),
+        'allocs_per_sec': Val('float', st['allocs_per_sec']),
+        'frees_per_sec': Val('float', st['frees_per_sec']),
+        'refcounts': int_tuple(st['refcounts']),
+        'slots': int_tuple({t: n for t, (n, size) in st['types'].items()}),
+        'bytes': int_tuple({t: size for t, (n, size) in st['types'].items()}),
+    })
+
+@larkfunction(interp=True)
+def _heap_snapshot(interp):
+    snap = larkmem.snapshot(interp.root.memory)
+    return Tuple([], named={k: Tuple([Val('int', n), Val('int', size)])
+        for k, (n, size) in snap.items()})
+
+@larkfunction
+def _heap_diff(before, after):
+    assert isinstance(before, Tuple) and isinstance(after, Tuple)
+    unpack = lambda t: {k: (v.data[0].data, v.data[1].data) for k, v in t.named.items()}
+    return Tuple([Tuple([Val('string', k), Val('int', n), Val('int', size)])
+        for k, n, size in larkmem.diff(unpack(before), unpack(after))])
+
+# pvals are called when named, so builtins taking one also accept ^name
+def deref(interp, v):
+    if isinstance(v, Ref):
+        return interp.root.memory[v.addr].val
+    return v
+
+def apply(f, *args):
+    try:
+        return f(*args)
+    except LarkReturn as e:
+        return e.value
+
+@larkfunction
+def _seq(v):
+    return Seq(v.iterate())
+
+@larkfunction
+def _collect(s):
+    return Tuple(list(s.iterate()))
+
+# over a tuple, map and filter run eagerly and return a tuple; over any
+# other sequence they stay lazy
+@larkfunction(interp=True)
+def _map(interp, f, s):
+    f = deref(interp, f)
+    if isinstance(s, Tuple):
+        call = Caller(f)
+        try:
+            return Tuple([call(x) for x in s.iterate()])
+        finally:
+            call.close()
+    return Seq(apply(f, x) for x in s.iterate())
+
+@larkfunction(interp=True)
+def _filter(interp, f, s):
+    f = deref(interp, f)
+    if isinstance(s, Tuple):
+        call = Caller(f)
+        try:
+            return Tuple([x for x in s.iterate() if call(x) == true])
+        finally:
+            call.close()
+    return Seq(x for x in s.iterate() if apply(f, x) == true)
+
+@larkfunction
+def _range(start, stop=nil, step=nil):
+    if stop == nil:
+        start, stop = Val('int', 0), start
+    return Range(start.data, stop.data, 1 if step == nil else step.data)
+
+@larkfunction
+def _take(s, n):
+    return Seq(itertools.islice(s.iterate(), n.data))
+
+@larkfunction(interp=True)
+def _reduce(interp, f, s, init):
+    call = Caller(deref(interp, f))
+    acc = init
+    try:
+        for x in s.iterate():
+            acc = call(acc, x)
+    finally:
+        call.close()
+    return acc
+
+# python values to order lark values by; tuples compare member-wise
+def sort_key(v):
+    if isinstance(v, Tuple):
+        return tuple(sort_key(x) for x in v.iterate())
+    return v.data
+
+# the key pval runs once per element, not once per comparison
+@larkfunction(interp=True)
+def _sort(interp, t, key=nil):
+    items = list(t.iterate())
+    if key == nil:
+        return Tuple(sorted(items, key=sort_key))
+    call = Caller(deref(interp, key))
+    try:
+        decorated = [(sort_key(call(x)), i, x) for i, x in enumerate(items)]
+    finally:
+        call.close()
+    decorated.sort()
+    return Tuple([x for k, i, x in decorated])
+
+@larkfunction(interp=True)
+def _spawn(interp, f, args=nil):
+    f = deref(interp, f)
+    args = () if args == nil else tuple(args.iterate())
+    return Task(f, args)
+
+# waits for a task, or for a python future (anything with a result method)
+# returned from extern code
+@larkfunction
+def _await(t):
+    if isinstance(t, Task):
+        return t.wait()
+    elif isinstance(t, PyVal) and hasattr(t.data, 'result'):
+        return as_lark(t.data.result())
+    return t
+
+@larkfunction
+def _gather(t):
+    assert isinstance(t, Tuple)
+    return Tuple([_await(x) for x in t.iterate()])
+
+# lines[nil] reads stdin, lines[path] a file and lines[b] splits bytes into
+# zero-copy slices
+@larkfunction(interp=True)
+def _lines(interp, src=nil):
+    if src == nil:
+        interp.out.flush()
+        return Seq(itertools.imap(as_lark, larkio.stdin_lines()))
+    elif isinstance(src, Buffer):
+        return Seq(src.slice(a, b) for a, b in larkio.line_spans(src.data))
+    try:
+        open(src.data, 'rb').close()
+    except IOError as error:
+        raise LarkException(str(error))
+    return Seq(itertools.imap(as_lark, larkio.file_lines(src.data)))
+
+@larkfunction
+def _mmap(path):
+    try:
+        return Buffer(larkio.map_file(path.data))
+    except (IOError, OSError) as error:
+        raise LarkException(str(error))
+
+@larkfunction
+def _text(b):
+    assert isinstance(b, Buffer)
+    return Val('string', larkio.chunk(b.data, 0, len(b.data)))
+
+@larkfunction
+def _writer(path):
+    try:
+        return PyVal(larkio.Writer(open(path.data, 'wb')))
+    except IOError as error:
+        raise LarkException(str(error))
+
+@larkfunction
+def _write(w, x):
+    assert isinstance(w, PyVal) and isinstance(w.data, larkio.Writer)
+    w.data.write(larkio.chunk(x.data, 0, len(x.data)) if isinstance(x, Buffer) else str(x))
+    return w
+
+@larkfunction
+def _close(w):
+    assert isinstance(w, PyVal) and isinstance(w.data, larkio.Writer)
+    w.data.close()
+    return nil
+
+@larkfunction
+def _serialize(v, w=nil):
+    if w == nil:
+        return Buffer(larkcodec.dumps(v))
+    assert isinstance(w, PyVal) and isinstance(w.data, larkio.Writer)
+    w.data.write(larkcodec.dumps(v))
+    return w
+
+def codec_file(path):
+    try:
+        return open(path.data, 'rb')
+    except IOError as error:
+        raise LarkException(str(error))
+
+# a bytes value is decoded in place, a string names a file to stream from
+@larkfunction
+def _deserialize(src):
+    if isinstance(src, Buffer):
+        return larkcodec.loads(src.data)
+    with codec_file(src) as f:
+        return larkcodec.load(larkcodec.Reader(f.read))
+
+# every value in a stream of concatenated serialize output, decoded lazily
+@larkfunction
+def _deserialize_all(src):
+    if isinstance(src, Buffer):
+        return Seq(larkcodec.load_all(larkcodec.view_reader(src.data)))
+    return Seq(larkcodec.file_values(codec_file(src)))
+
+class PortablePval(object):
+    # picklable snapshot of a pval: its body, params and captured values
+    def __init__(self, prog, params, generator=False):
+        self.prog = prog
+        self.params = params
+        self.generator = generator
+        self.captures = {}
+
+class PortableBuiltin(object):
+    def __init__(self, name):
+        self.name = name
+
+# free names of the pval literals nested in a body, which only resolve once
+# the body runs and so aren't among the outer pval's names
+def nested_refs(node, bound, out):
+    if isinstance(node, list):
+        for x in node:
+            nested_refs(x, bound, out)
+    elif isinstance(node, tuple) and node and node[0] == 'pval':
+        body = node[-2]
+        inner = larkspec.assigned_names(body, set(bound))
+        if len(node) == 4:
+            inner.update(p[1] for p in node[1])
+        out.update(n for n in node[-1] if n not in inner)
+        nested_refs(body, inner, out)
+    elif isinstance(node, tuple):
+        for x in node[1:] if node and isinstance(node[0], str) else node:
+            if isinstance(x, (tuple, list)):
+                nested_refs(x, bound, out)
+    return out
+
+def freeze(v, memo, name=None):
+    if isinstance(v, Builtin):
+        return PortableBuiltin(v.name)
+    elif isinstance(v, ParamVal):
+        if id(v) in memo:
+            return memo[id(v)]
+        if v.prog is None:
+            raise LarkException("Cannot send native pval '{0}' to worker processes.".format(name))
+        params = []
+        for p in v.params:
+            if p[0] == 'ref':
+                raise LarkException("Cannot send pval with reference parameter '{0}' to worker processes.".format(p[1]))
+            elif p[0] == 'default':
+                params.append(('default', p[1], freeze(p[2], memo, p[1])))
+            else:
+                params.append(p)
+        frozen = memo[id(v)] = PortablePval(v.prog, params, v.generator)
+        bound = larkspec.assigned_names(v.prog, set(p[1] for p in v.params))
+        for n in set(v.names) | nested_refs(v.prog, bound, set()):
+            frozen.captures[n] = freeze(v.cl.retrieve_val(v.cl.getref(n)), memo, n)
+        return frozen
+    elif isinstance(v, Tuple):
+        return Tuple([freeze(x, memo, name) for x in v.iterate()],
+                named={k:freeze(x, memo, k) for k,x in v.named.items()})
+    elif isinstance(v, Map):
+        return Map((k, freeze(x, memo, name)) for k, x in v.items())
+    elif isinstance(v, (PyVal, Buffer)):
+        try:
+            pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+        except Exception as error:
+            raise LarkException("Cannot send python value '{0}' to worker processes: {1}".format(name, error))
+    return v
+
+def thaw(v, env, memo):
+    if isinstance(v, PortablePval):
+        if id(v) in memo:
+            return memo[id(v)]
+        cl = Env(parent=env)
+        params = [('default', p[1], thaw(p[2], env, memo)) if p[0] == 'default' else p for p in v.params]
+        pv = memo[id(v)] = make_pval(v.prog, params, cl, sorted(v.captures.keys()), refs=[])
+        pv.generator = v.generator
+        for n, x in v.captures.items():
+            if isinstance(x, PortableBuiltin):
+                continue
+            parts = n.split('::')
+            ns = cl
+            for part in parts[:-1]:
+                ns = ns.get_or_create_ns(part)
+            ns.new_assign(parts[-1], thaw(x, env, memo))
+        pv.refs = [cl.getref(n) for n in pv.names]
+        for r in pv.refs:
+            cl.incref(r)
+        return pv
+    elif isinstance(v, PortableBuiltin):
+        return env.retrieve_val(env.getref(v.name))
+    elif isinstance(v, Tuple):
+        return Tuple([thaw(x, env, memo) for x in v.data],
+                named={k:thaw(x, env, memo) for k,x in v.named.items()})
+    elif isinstance(v, Map):
+        return Map((k, thaw(x, env, memo)) for k, x in v.items())
+    return v
+
+pmap_fn = None
+
+def pmap_init(blob):
+    global pmap_fn
+    interp = Interpreter()
+    pmap_fn = thaw(pickle.loads(blob), interp.root, {})
+
+def pmap_call(arg):
+    return freeze(apply(pmap_fn, arg), {})
+
+@larkfunction(interp=True)
+def _pmap(interp, f, t, workers=nil, chunksize=nil):
+    assert isinstance(t, Tuple)
+    f = deref(interp, f)
+    memo = {}
+    try:
+        blob = pickle.dumps(freeze(f, memo, 'f'), pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError) as error:
+        raise LarkException("Cannot send pval to worker processes: {0}".format(error))
+    args = [freeze(x, memo) for x in t.iterate()]
+    pool = Pool(as_py(workers), initializer=pmap_init, initargs=(blob,))
+    try:
+        results = pool.map(pmap_call, args, chunksize=as_py(chunksize) or 1)
+    finally:
+        pool.close()
+        pool.join()
+    env = Env(parent=interp.root)
+    memo = {}
+    return Tuple([thaw(r, env, memo) for r in results])
+
+class Interpreter(object):
+    # owns all state needed to run lark programs, so separate instances can
+    # run concurrently in one process
+    # with a parent, the interpreter is a child scope of the parent's root:
+    # globals, builtins and imported modules are shared, while output, extern
+    # state and new definitions stay local to the child
+    def __init__(self, out=None, parent=None, lazy_imports=False):
+        self.parser = Parser()
+        self.out = larkio.Writer(out if out is not None else sys.stdout)
+        self.parent = parent
+        self.lazy_imports = lazy_imports or (parent is not None and parent.lazy_imports)
+        if parent is None:
+            self.extern_globals = {}
+            self.extern_locals = {}
+            self.root = Env(memory=Mem(), interp=self)
+        else:
+            self.extern_globals = dict(parent.extern_globals)
+            self.extern_locals = dict(parent.extern_locals)
+            self.root = Env(parent=parent.root, interp=self)
+        # process-bound objects images refer to by name
+        self.natives = {}
+        for fn, copy_args, interp in builtins:
+            # children only rebind the builtins that use the interpreter
+            if parent is not None and not interp:
+                continue
+            name = fn.func_name.lstrip('_')
+            params = list(fn.__code__.co_varnames[:fn.__code__.co_argcount])
+            defaults = fn.func_defaults or ()
+            if interp:
+                fn = partial(fn, self)
+                params = params[1:]
+            self.natives[name] = Builtin(fn, name, params,
+                defaults=defaults, copy_args=copy_args)
+        self.natives['dump'] = ParamVal(fn_dump, cl=self.root)
+        for name, v in self.natives.items():
+            self.root.new_assign(name, v)
+        self.natives['interpreter'] = self
+        self.natives['run_program'] = run_program
+
+    # releases a child's slots in the shared memory, including those of the
+    # namespaces it imported or defined; namespaces reached from an
+    # ancestor's scope belong to that ancestor and are left alone
+    def close(self):
+        self.out.flush()
+        if self.parent is not None:
+            shared = {}
+            interp = self.parent
+            while interp is not None:
+                namespace_envs(interp.root, shared)
+                interp = interp.parent
+            for key, env in namespace_envs(self.root, {}).items():
+                if key not in shared:
+                    env.cleanup()
+                    env.vars = {}
+
+    def parse(self, source, filename='<string>'):
+        return self.parser.parse(source, filename=filename)
+
+    def parse_file(self, path):
+        return parse_file(path, parse=self.parse)
+
+    # saves root with everything defined in it, so a later process can skip
+    # parsing and running its setup; extern state other than imported python
+    # modules is not saved
+    def save_image(self, path):
+        modules = {k: v for k, v in self.extern_locals.items() if isinstance(v, types.ModuleType)}
+        try:
+            with open(path, 'wb') as f:
+                larkimage.save(self.root, modules, self.natives, f)
+        except LarkException:
+            os.unlink(path)
+            raise
+
+    def load_image(self, path):
+        with open(path, 'rb') as f:
+            self.root, modules = larkimage.load(self.natives, f)
+        self.extern_locals.update(modules)
+
+    def prepare(self, source, filename='<string>'):
+        return Program(self, self.parse(source, filename=filename))
+
+    def prepare_file(self, path):
+        return Program(self, self.parse_file(path))
+
+    # runs the file behind a lazy import, once, and returns the namespace
+    # the placeholder stands for
+    def load_namespace(self, lazy):
+        module = lazy.module
+        env = lazy.parent
+        with module.lock:
+            if module.env is None:
+                try:
+                    prog = self.parse_file(module.path)
+                except IOError as error:
+                    raise LarkException(error.message)
+                # visible while running, so circular lookups see the
+                # partly run file instead of loading it again
+                module.env = Env(parent=env)
+                try:
+                    run_program(prog, module.env)
+                except:
+                    module.env = None
+                    raise
+        ns = module.env
+        for n in lazy.parts:
+            ns = ns.get_ns(n)
+        return ns
+
+    def execute(self, prog, env=None):
+        try:
+            return run_program(prog, env or self.root)
+        finally:
+            self.out.flush()
+
+    def run(self, source, env=None):
+        return self.execute(self.parse(source), env)
+
+    def run_file(self, path, env=None):
+        return self.execute(self.parse_file(path), env)
+
+class Program(object):
+    # a parsed program for running repeatedly from python. Each run gets a
+    # fresh scope under the interpreter's root with the inputs bound in it;
+    # hooks are called with the program and the seconds each run took.
+    def __init__(self, interp, prog):
+        self.interp = interp
+        self.prog = prog
+        self.hooks = []
+        self.calls = 0
+        self.seconds = 0.0
+
+    def add_hook(self, fn):
+        self.hooks.append(fn)
+        return fn
+
+    def run(self, inputs=None, **kwargs):
+        start = time.time()
+        env = Env(parent=self.interp.root)
+        try:
+            for scope in (inputs, kwargs):
+                if scope:
+                    for name, value in scope.items():
+                        env.new_assign(name, as_lark(value))
+            return as_py(self.interp.execute(self.prog, env))
+        finally:
+            env.cleanup()
+            elapsed = time.time() - start
+            self.calls += 1
+            self.seconds += elapsed
+            for fn in self.hooks:
+                fn(self, elapsed)
+
+    __call__ = run
 
 def parse_import_path(name):
     parts = name.split('::')
@@ -96,13 +688,25 @@ def parse_import_path(name):
 
 def import_file(name, env, _as=None):
     path, ns_name, parts = parse_import_path(name)
+    if env.interp.lazy_imports:
+        # the file ns and, if different, the imported one both stay
+        # placeholders until first used
+        existing = env.namespaces.get(ns_name)
+        if isinstance(existing, LazyNamespace) and existing.module.path == path and not existing.parts:
+            module = existing.module
+        else:
+            module = LazyModule(path)
+            env.set_ns(ns_name, LazyNamespace(env, ns_name, module))
+        if parts or _as is not None:
+            final = _as if _as is not None else parts[-1]
+            env.set_ns(final, LazyNamespace(env, final, module, parts))
+        return nil
     try:
-        with open(path, 'rb') as f:
-            content = f.read()
+        prog = env.interp.parse_file(path)
     except IOError as error:
         raise LarkException(error.message)
     ns = env.get_or_create_ns(ns_name)
-    last = run_program(parse(content), ns)
+    last = run_program(prog, ns)
     for n in parts:
         ns = ns.get_ns(n)
         ns_name = n
@@ -111,6 +715,27 @@ def import_file(name, env, _as=None):
     env.set_ns(ns_name, ns)
     return last
 
+# env and every env reachable through its namespaces, by id
+def namespace_envs(env, out):
+    if id(env) in out:
+        return out
+    out[id(env)] = env
+    if isinstance(env, LazyNamespace):
+        if env.module.env is not None:
+            namespace_envs(env.module.env, out)
+        if env.target is not None:
+            namespace_envs(env.target, out)
+    for ns in env.namespaces.values():
+        namespace_envs(ns, out)
+    return out
+
+def make_pval(prog, params, env, names, refs=None):
+    if refs is None:
+        refs = [env.getref(e) for e in names]
+    # a partial rather than a lambda, so images can pickle the body
+    inner = partial(run_program, prog)
+    return ParamVal(v=inner, params=params, cl=env, refs=refs, prog=prog, names=names)
+
 def run_program(prog, env):
     last = nil
     for expr in prog:
@@ -118,97 +743,114 @@ def run_program(prog, env):
             last = evaluate(expr, env)
     return last
 
-def binary_num_ops(op, l, r):
-    assert r.type in ['int', 'float']
-    if l.type == 'float' or r.type == 'float':
-        out_type = 'float'
-    else:
-        out_type = 'int'
-    if op == "+":
-        v = l.data + r.data
-    elif op == "-":
-        v = l.data - r.data
-    elif op == "*":
-        v = l.data * r.data
-    elif op == "/":
-        v = l.data / r.data
-    elif op == "<":
-        return true if l.data < r.data else false
-    elif op == ">":
-        return true if l.data > r.data else false
-    elif op == "<=":
-        return true if l.data <= r.data else false
-    elif op == ">=":
-        return true if l.data >= r.data else false
-    return Val(out_type, v)
-
-def binary_string_ops(op, l, r):
-    if op == "+":
-        assert r.type == 'string'
-        v = l.data + r.data
-    elif op == "-":
-        raise LarkException("Operator '-' is not defined for types {0} and {1}.".format(l.type, r.type))
-    elif op == "*":
-        raise LarkException("Operator '*' is not defined for types {0} and {1}.".format(l.type, r.type))
-    elif op == "/":
-        return Tuple(l.data.split(r.data))
-    elif op == "<":
-        return true if l.data < r.data else false
-    elif op == ">":
-        return true if l.data > r.data else false
-    elif op == "<=":
-        return true if l.data <= r.data else false
-    elif op == ">=":
-        return true if l.data >= r.data else false
-    return Val('string', v)
-
-def binary_tuple_ops(op, l, r):
-    try:
-        fn = l.getmember(op) 
-        return fn(l, r)
-    except LarkException:
-        pass
-    if op == "+":
-        assert r.type == 'tuple'
-        return Tuple(l.data + r.data, named=dict(l.named, **r.named))
-    elif op == "<":
-        return true if len(l.data) < len(r.data) else false
-    elif op == ">":
-        return true if len(l.data) > len(r.data) else false
-    elif op == "<=":
-        return true if len(l.data) <= len(r.data) else false
-    elif op == ">=":
-        return true if len(l.data) >= len(r.data) else false
-    else:
-        raise LarkException("Operator '{0}' is not defined for types {1} and {2}.".format(op, l.type, r.type))
+def num_op(fn, out_type):
+    return lambda l, r: Val(out_type, fn(l.data, r.data))
+
+def cmp_op(fn):
+    return lambda l, r: true if fn(l.data, r.data) else false
+
+def eq(l, r):
+    return true if l.data == r.data else false
+
+def ne(l, r):
+    return true if not (l.data == r.data) else false
+
+arith = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div,
+    '%': operator.mod,
+}
+comparisons = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+# (op, left type, right type) -> handler taking the two evaluated operands
+binary_ops = {}
+for lt, rt in itertools.product(['int', 'float'], repeat=2):
+    out_type = 'int' if lt == rt == 'int' else 'float'
+    for op, fn in arith.items():
+        binary_ops[op, lt, rt] = num_op(fn, out_type)
+for lt, rt in list(itertools.product(['int', 'float'], repeat=2)) + [('string', 'string')]:
+    for op, fn in comparisons.items():
+        binary_ops[op, lt, rt] = cmp_op(fn)
+    binary_ops['==', lt, rt] = eq
+    binary_ops['!=', lt, rt] = ne
+binary_ops['+', 'string', 'string'] = num_op(operator.add, 'string')
+binary_ops['/', 'string', 'string'] = lambda l, r: Tuple(l.data.split(r.data))
+
+def len_cmp_op(fn):
+    return lambda l, r: true if fn(l.length(), r.length()) else false
+
+# two python lists stay a view instead of being boxed to be concatenated
+def tuple_add(l, r):
+    if isinstance(l, ListView) and isinstance(r, ListView):
+        return ListView(list(l.obj) + list(r.obj))
+    return Tuple(list(l.iterate()) + list(r.iterate()), named=dict(l.named, **r.named))
+
+tuple_ops = {op: len_cmp_op(fn) for op, fn in comparisons.items()}
+tuple_ops['+'] = tuple_add
+
+# structural, named members included, so == agrees with hash_key
+def tuple_eq(l, r):
+    return true if l == r else false
+
+def tuple_ne(l, r):
+    return false if l == r else true
+
+def overloaded(op):
+    return lambda l, r: l.getmember(op)(l, r)
+
+# operand types with no table entry: equality on anything, then tuples that
+# define the operator as a member, then the builtin tuple operators
+def resolve_binary(op, l, r):
+    if op in ('==', '!=') and 'tuple' in (l.type, r.type):
+        return tuple_eq if op == '==' else tuple_ne
+    elif op == '==':
+        return eq
+    elif op == '!=':
+        return ne
+    elif l.type == 'tuple':
+        if l.hasmember(op):
+            return overloaded(op)
+        if op == '+' and r.type == 'tuple' or op in comparisons:
+            return tuple_ops[op]
+    raise LarkException("Operator '{0}' is not defined for types {1} and {2}.".format(op, l.type, r.type))
 
 def binary_expr(op, lhs, rhs, env):
     l = evaluate(lhs, env)
     r = evaluate(rhs, env)
-    if op == "==":
-        return true if l.data == r.data else false
-    elif op == "!=":
-        return true if not (l.data == r.data) else false
-
-    if l.type in ['int', 'float']:
-        return binary_num_ops(op, l, r)
-    elif l.type == 'string':
-        return binary_string_ops(op, l, r)
-    elif l.type == 'tuple':
-        return binary_tuple_ops(op, l, r)
+    fn = binary_ops.get((op, l.type, r.type))
+    if fn is None:
+        fn = resolve_binary(op, l, r)
+    return fn(l, r)
+
+def negate(v):
+    return Val(v.type, -v.data)
+
+def logical_not(v):
+    if v == false or v == nil or (v.length() == 0 if isinstance(v, Tuple) else not v.data):
+        return true
     else:
-        raise LarkException("Operator '{0}' is not defined for types {1} and {2}.".format(op, l.type, r.type))
+        return false
+
+unary_ops = {
+    ('-', 'int'): negate,
+    ('-', 'float'): negate,
+}
 
 def unary_expr(op, v, env):
     v = evaluate(v, env)
-    if op == '-':
-        assert v.type in ['int', 'float']
-        return Val(v.type, -v.data)
+    fn = unary_ops.get((op, v.type))
+    if fn is not None:
+        return fn(v)
     elif op == '!':
-        if v == false or v == nil or not v.data:
-            return true
-        else:
-            return false
+        return logical_not(v)
+    raise LarkException("Operator '{0}' is not defined for type {1}.".format(op, v.type))
 
 def evaluate(expr, env):
     if isinstance(expr, Val):
@@ -235,7 +877,9 @@ def evaluate(expr, env):
                     a = a.data
                 if a in named:
                     raise LarkException("Member '{0}' redefined in tuple literal".format(a))
-                named[a] = evaluate(x[2], env) 
+                named[a] = evaluate(x[2], env)
+                if isinstance(named[a], ParamVal) and named[a].name is None:
+                    named[a].name = str(a)
             else:
                 members.append(evaluate(x, env))
         return Tuple(members, named=named)
@@ -279,15 +923,23 @@ def evaluate(expr, env):
             ref= env.getref(expr[1])
         else:
             ref = env.getlocal_ormakeref(expr[1])
-        return env.assign(ref, evaluate(expr[2], env))
+        v = evaluate(expr[2], env)
+        if isinstance(v, ParamVal) and v.name is None:
+            v.name = expr[1]
+        return env.assign(ref, v)
     elif t == 'namespace':
         ns = env.get_or_create_ns(expr[1])
         return run_program(expr[2], ns)
     elif t == 'extern':
-        exec expr[1] in extern_globals, extern_locals
-        return as_lark(extern_locals)
+        # python code may write to stdout itself
+        interp = env.interp
+        interp.out.flush()
+        exec expr[1] in interp.extern_globals, interp.extern_locals
+        return as_lark(interp.extern_locals)
     elif t == 'extern-expr':
-        return as_lark(eval(expr[1], extern_globals, extern_locals))
+        interp = env.interp
+        interp.out.flush()
+        return as_lark(eval(expr[1], interp.extern_globals, interp.extern_locals))
     elif t == 'return':
         ret = LarkReturn("Return outside of pval.")
         ret.value = expr[1]
@@ -308,17 +960,30 @@ def evaluate(expr, env):
             except LarkBreak: # should set last to nil maybe?
                 break
         return last
+    elif t == 'for':
+        # the loop variable is one slot, overwritten for each element
+        ref = env.getlocal_ormakeref(expr[1])
+        slot = env.memory[ref.addr]
+        body = expr[3]
+        last = nil
+        for x in evaluate(expr[2], env).iterate():
+            slot.val = x
+            try:
+                last = run_program(body, env)
+            except LarkContinue:
+                continue
+            except LarkBreak:
+                break
+        return last
     elif t == 'import':
         return import_file(expr[1], env)
     elif t == 'import-as':
         return import_file(expr[1], env, _as=expr[2])
     elif t == 'extern-import':
         basename = expr[1].split('.')[-1]
-        exec 'import {0}'.format(expr[1]) in extern_globals, extern_locals
-        module = Env(memory=env.memory)
-        for k, v in vars(extern_locals.get(basename)).items():
-            module.new_assign(k, as_lark(v))
-        env.set_ns(basename, module)
+        interp = env.interp
+        exec 'import {0}'.format(expr[1]) in interp.extern_globals, interp.extern_locals
+        env.set_ns(basename, PyNamespace(interp.extern_locals.get(basename), env.memory))
     elif t == 'group': # should this have its own scope?
         return run_program(expr[1], env)
     elif t == 'cond-else':
@@ -355,9 +1020,17 @@ def evaluate(expr, env):
                     params.append(p)
             prog = expr[2]
                     
-        refs = [env.getref(e) for e in expr[-1] if e not in param_names]
-        inner = lambda e: run_program(prog, e)
-        return ParamVal(v=inner, params=params, cl=env, refs=refs)
+        names = [e for e in expr[-1] if e not in param_names]
+        pv = make_pval(prog, params, env, names)
+        pv.location, pv.spans = lookup(expr)
+        return pv
+    elif t == 'generator':
+        pv = evaluate(expr[1], env)
+        pv.generator = True
+        pv.location, pv.spans = lookup(expr)
+        return pv
+    elif t == 'yield':
+        return yield_value(evaluate(expr[1], env))
     elif t == 'ref':
         return env.getref(expr[1])
     elif t == 'evaluation':
@@ -382,11 +1055,35 @@ def evaluate(expr, env):
         return ret
     return nil
 
+ParamVal.specializer = larkspec.Specializer(evaluate, binary_expr, binary_ops)
+
+@larkfunction
+def _spec_stats():
+    specializer = ParamVal.specializer
+    if specializer is None:
+        return Tuple([], named={'enabled': false})
+    st = specializer.stats()
+    return Tuple([], named={
+        'enabled': true,
+        'specialized': Val('int', st['specialized']),
+        'deopts': Val('int', st['deopts']),
+        'despecialized': Val('int', st['despecialized']),
+        'pvals': Tuple([Tuple([Val('string', name), Val('string', sig), Val('int', calls),
+            Val('int', hits), Val('int', deopts)]) for name, sig, calls, hits, deopts in st['pvals']]),
+    })
+
+# default interpreter used by the command line
+interpreter = Interpreter()
+root = interpreter.root
+
+def prepare(source, filename='<string>'):
+    return interpreter.prepare(source, filename=filename)
+
 pairs = {
     '(': ')',
     '[': ']',
     '{': '}',
-    'if|loop': 'end',
+    'if|loop|for': 'end',
 }
 even = [
     '"""',
@@ -394,33 +1091,130 @@ even = [
 ]
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        with open(sys.argv[1], 'rb') as f:
-            prog = parse(f.read())
-        run_program(prog, root)
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('script', nargs='?')
+    argparser.add_argument('--compile-all', metavar='DIR',
+            help='parse every lark file under DIR and write cached ASTs')
+    argparser.add_argument('--jobs', type=int, default=None,
+            help='number of worker processes for --compile-all')
+    argparser.add_argument('--output', metavar='FILE',
+            help='write program output to FILE instead of stdout')
+    argparser.add_argument('--image', metavar='FILE',
+            help='start from an interpreter image saved with --save-image')
+    argparser.add_argument('--save-image', metavar='FILE',
+            help='after running the script, save the interpreter state to FILE')
+    argparser.add_argument('--serve', action='store_true',
+            help='after running the script, answer JSON-lines requests on stdin')
+    argparser.add_argument('--socket', metavar='PATH',
+            help='with --serve, listen on a unix socket at PATH instead of stdin')
+    argparser.add_argument('--workers', type=int, default=1,
+            help='number of requests --serve runs at once')
+    argparser.add_argument('--lazy-imports', action='store_true',
+            help='run imported files on first use instead of at the import')
+    argparser.add_argument('--no-specialize', action='store_true',
+            help='always run pvals through the generic evaluator')
+    argparser.add_argument('--profile', action='store_true',
+            help='profile pval calls and print a table to stderr on exit')
+    argparser.add_argument('--profile-output', metavar='FILE',
+            help='also write the profile to FILE in pstats format')
+    argparser.add_argument('--mem-report', action='store_true',
+            help='print memory stats and the largest retainers to stderr on exit')
+    argparser.add_argument('--sample', metavar='FILE',
+            help='sample the lark call stack and write folded stacks to FILE')
+    argparser.add_argument('--sample-interval', metavar='MS', type=float, default=5.0,
+            help='milliseconds between samples for --sample')
+    args = argparser.parse_args()
+
+    if args.output is not None or args.lazy_imports:
+        out = open(args.output, 'wb') if args.output is not None else None
+        interpreter = Interpreter(out=out, lazy_imports=args.lazy_imports)
+        root = interpreter.root
+
+    if args.no_specialize:
+        ParamVal.specializer = None
+
+    if args.image is not None:
+        interpreter.load_image(args.image)
+        root = interpreter.root
+
+    if args.profile or args.profile_output:
+        import atexit
+        from larkprof import Profiler
+
+        profiler = Profiler(root.memory)
+        profiler.enable()
+        def report():
+            profiler.disable()
+            profiler.print_stats()
+            if args.profile_output:
+                profiler.dump_stats(args.profile_output)
+        atexit.register(report)
+
+    if args.mem_report:
+        import atexit
+        atexit.register(lambda: larkmem.print_report(root.memory))
+
+    if args.sample:
+        import atexit
+        from larkprof import Sampler
+
+        sampler = Sampler(evaluate, interval=args.sample_interval / 1000.0)
+        sampler.start()
+        def write_samples():
+            sampler.stop()
+            with open(args.sample, 'wb') as f:
+                sampler.write_folded(f)
+        atexit.register(write_samples)
+
+    if args.compile_all is not None:
+        count, errors = compile_all(args.compile_all, jobs=args.jobs)
+        for path, error in errors:
+            sys.stderr.write("{0}: SyntaxError: {1}\n".format(path, error))
+        sys.stderr.write("compiled {0} of {1} files\n".format(count - len(errors), count))
+        sys.exit(1 if errors else 0)
+    elif args.serve:
+        from larkserve import Server
+
+        if args.script is not None:
+            interpreter.run_file(args.script)
+        server = Server(interpreter, workers=args.workers)
+        if args.socket is not None:
+            server.serve_socket(args.socket)
+        else:
+            server.serve_lines(sys.stdin, sys.stdout)
+    elif args.script is not None or args.save_image is not None:
+        if args.script is not None:
+            interpreter.run_file(args.script)
+        if args.save_image is not None:
+            interpreter.save_image(args.save_image)
     else:
         import readline
         import traceback
 
         lines = ""
-        partial = False
+        pending = False
         while True:
-            l = raw_input(".... " if partial else "lrk> ")
+            l = raw_input(".... " if pending else "lrk> ")
             lines += l + '\n'
-            partial = False
+            pending = False
             for start,end in pairs.items():
                 if sum(lines.count(s) for s in start.split('|')) != lines.count(end):
-                    partial = True
+                    pending = True
                     break
             for mark in even:
                 if (lines.count(mark) % 2) != 0:
-                    partial = True
+                    pending = True
                     break
-            if not partial:
+            if not pending:
                 try:
-                    prog = parse(lines)
+                    prog = interpreter.parse(lines)
                     if prog:
-                        res = run_program(prog, root)
+                        try:
+                            res = run_program(prog, root)
+                        finally:
+                            interpreter.out.flush()
                         if res != nil:
                             print repr(res)
                 except SyntaxError as error:
@@ -0,0 +1,95 @@
+import os
+import errno
+import hashlib
+import binascii
+import cPickle as pickle
+from multiprocessing import Pool
+
+from larkparse import parse, with_spans
+from core import LarkException
+
+CACHE_VERSION = 8
+extensions = ['.lk', '.lrk', '.lark']
+
+def cache_path(path):
+    return '{0}c'.format(path)
+
+def source_key(content):
+    return hashlib.sha1(content).hexdigest()
+
+def load_cached(path, content):
+    try:
+        with open(cache_path(path), 'rb') as f:
+            version, key, prog, spans = pickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+    if version != CACHE_VERSION or key != source_key(content):
+        return None
+    return with_spans(prog, spans, filename=path)
+
+# the temp file is opened with the usual cache mode, so the umask applies as
+# for any file and caches written by one user (say, at deploy) can be read by
+# another; mkstemp files are private to their owner
+def open_temp(path):
+    prefix = os.path.join(os.path.dirname(os.path.abspath(path)),
+            '.{0}.'.format(os.path.basename(path)))
+    while True:
+        tmp = prefix + binascii.hexlify(os.urandom(6))
+        try:
+            return os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644), tmp
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+def write_cached(path, content, prog):
+    # write to a temp file next to the cache and rename it into place, so
+    # concurrent readers never see a partially written cache
+    fd, tmp = open_temp(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((CACHE_VERSION, source_key(content), list(prog), prog.spans.pairs()),
+                    f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, cache_path(path))
+    except:
+        os.unlink(tmp)
+        raise
+
+def parse_file(path, parse=parse):
+    with open(path, 'rb') as f:
+        content = f.read()
+    prog = load_cached(path, content)
+    if prog is None:
+        prog = parse(content, filename=path)
+        try:
+            write_cached(path, content, prog)
+        except (IOError, OSError):
+            pass
+    return prog
+
+def compile_file(path):
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        write_cached(path, content, parse(content, filename=path))
+    except LarkException as error:
+        return path, error.message
+    except (IOError, OSError) as error:
+        return path, str(error)
+    return path, None
+
+def find_sources(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1] in extensions:
+                yield os.path.join(dirpath, name)
+
+def compile_all(top, jobs=None):
+    paths = list(find_sources(top))
+    pool = Pool(jobs)
+    try:
+        results = pool.map(compile_file, paths, chunksize=8)
+    finally:
+        pool.close()
+        pool.join()
+    return len(paths), [(path, err) for path, err in results if err is not None]
@@ -0,0 +1,237 @@
+import gc
+import struct
+
+from core import Val, Tuple, Map, Set, Buffer, LarkException, nil, true, false
+from larkio import BUFFER_SIZE, chunk
+
+# Every serialized value starts with MAGIC and a format version byte, so
+# values can be concatenated into one stream and read back one at a time.
+# After the header comes a one-byte tag and the value's payload; lengths and
+# ints are varints (ints zigzag-encoded, so longs of any size fit), floats
+# are little-endian doubles and tuples are their positional count, named
+# count, positional members, then (name, member) pairs.
+MAGIC = 'LKV'
+FORMAT_VERSION = 1
+HEADER = MAGIC + chr(FORMAT_VERSION)
+
+double = struct.Struct('<d')
+
+def varint_bytes(n):
+    out = []
+    while n > 0x7f:
+        out.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+# encoded lengths and small ints are looked up instead of built byte by byte
+varints = [varint_bytes(n) for n in xrange(1 << 14)]
+small_ints = {n: 'i' + varints[zigzag(n)] for n in xrange(-(1 << 13), 1 << 13)}
+
+def varint(n):
+    return varints[n] if n < 16384 else varint_bytes(n)
+
+# ints, strings and floats, the common members, are written without a call
+def encode_members(members, out):
+    append = out.append
+    for x in members:
+        t = getattr(x, 'type', 'ref')
+        if t == 'int':
+            s = small_ints.get(x.data)
+            append(s if s is not None else 'i' + varint_bytes(zigzag(x.data)))
+        elif t == 'string' and not isinstance(x.data, unicode):
+            s = x.data
+            n = len(s)
+            append(('s' + varints[n]) if n < 16384 else 's' + varint_bytes(n))
+            append(s)
+        elif t == 'float':
+            append('d' + double.pack(x.data))
+        else:
+            encode(x, out)
+
+def encode(v, out):
+    t = getattr(v, 'type', 'ref')
+    if t == 'int':
+        s = small_ints.get(v.data)
+        out.append(s if s is not None else 'i' + varint_bytes(zigzag(v.data)))
+    elif t == 'string':
+        # strings from python (e.g. decoded JSON) may be unicode; they come
+        # back as utf-8 bytes like every other lark string
+        s = v.data.encode('utf-8') if isinstance(v.data, unicode) else v.data
+        out.append('s' + varint(len(s)))
+        out.append(s)
+    elif t == 'float':
+        out.append('d' + double.pack(v.data))
+    elif t == 'bool':
+        out.append('T' if v.data else 'F')
+    elif t == 'niltype':
+        out.append('N')
+    elif isinstance(v, Tuple):
+        data = v.data if type(v) is Tuple else list(v.iterate())
+        named = v.named
+        out.append('t' + varint(len(data)) + varint(len(named)))
+        encode_members(data, out)
+        for k, x in named.iteritems():
+            out.append(varint(len(k)) + k)
+            encode(x, out)
+    elif isinstance(v, Map):
+        out.append('m' + varint(len(v.data)))
+        for k, x in v.data.itervalues():
+            encode(k, out)
+            encode(x, out)
+    elif isinstance(v, Set):
+        out.append('e' + varint(len(v.data)))
+        encode_members(v.data.itervalues(), out)
+    elif isinstance(v, Buffer):
+        s = chunk(v.data, 0, len(v.data))
+        out.append('b' + varint(len(s)))
+        out.append(s)
+    else:
+        raise LarkException("Cannot serialize value of type '{0}'.".format(t))
+
+def dumps(v):
+    out = [HEADER]
+    encode(v, out)
+    return ''.join(out)
+
+# pulls bytes from read(n) a block at a time, so decoding a large file or
+# mapping never holds more than a block beyond the value being built
+class Reader(object):
+    def __init__(self, read, size=BUFFER_SIZE):
+        self.read = read
+        self.size = size
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self, n):
+        parts = [self.buf[self.pos:]]
+        have = len(parts[0])
+        while have < n:
+            block = self.read(max(self.size, n - have))
+            if not block:
+                break
+            parts.append(block)
+            have += len(block)
+        self.buf = ''.join(parts)
+        self.pos = 0
+        return have >= n
+
+    def take(self, n):
+        if self.pos + n > len(self.buf) and not self.fill(n):
+            raise LarkException("Serialized value is truncated.")
+        s = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return s
+
+    def varint(self):
+        # most lengths and small ints fit in one byte
+        buf, pos = self.buf, self.pos
+        if pos < len(buf):
+            b = ord(buf[pos])
+            if b < 0x80:
+                self.pos = pos + 1
+                return b
+        n = shift = 0
+        while True:
+            if self.pos >= len(self.buf) and not self.fill(1):
+                raise LarkException("Serialized value is truncated.")
+            b = ord(self.buf[self.pos])
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def at_end(self):
+        return self.pos >= len(self.buf) and not self.fill(1)
+
+def view_reader(data):
+    # read(n) over a memoryview or buffer, copying one block per call
+    pos = [0]
+    def read(n):
+        s = chunk(data, pos[0], pos[0] + n)
+        pos[0] += len(s)
+        return s
+    return Reader(read)
+
+def decode_tuple(r):
+    npos = r.varint()
+    nnamed = r.varint()
+    t = Tuple([decode(r) for i in xrange(npos)])
+    for i in xrange(nnamed):
+        k = r.take(r.varint())
+        t.named[k] = decode(r)
+    return t
+
+def decode_map(r):
+    m = Map()
+    for i in xrange(r.varint()):
+        k = decode(r)
+        m.put(k, decode(r))
+    return m
+
+def decode_set(r):
+    s = Set()
+    for i in xrange(r.varint()):
+        s.put(decode(r))
+    return s
+
+decoders = {
+    'i': lambda r: Val('int', unzigzag(r.varint())),
+    's': lambda r: Val('string', r.take(r.varint())),
+    't': decode_tuple,
+    'd': lambda r: Val('float', double.unpack(r.take(8))[0]),
+    'T': lambda r: true,
+    'F': lambda r: false,
+    'N': lambda r: nil,
+    'm': decode_map,
+    'e': decode_set,
+    'b': lambda r: Buffer(r.take(r.varint())),
+}
+
+def decode(r):
+    buf, pos = r.buf, r.pos
+    if pos < len(buf):
+        tag = buf[pos]
+        r.pos = pos + 1
+    else:
+        tag = r.take(1)
+    try:
+        fn = decoders[tag]
+    except KeyError:
+        raise LarkException("Serialized value has unknown tag {0}.".format(repr(tag)))
+    return fn(r)
+
+def load(r):
+    header = r.take(len(HEADER))
+    if header[:len(MAGIC)] != MAGIC:
+        raise LarkException("Not a serialized lark value.")
+    if header != HEADER:
+        raise LarkException("Serialized value has unsupported format version {0}.".format(ord(header[-1])))
+    # decoding only allocates, so the cycle collector's passes over the
+    # growing value are wasted work
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return decode(r)
+    finally:
+        if enabled:
+            gc.enable()
+
+def loads(data):
+    return load(view_reader(data))
+
+def load_all(r):
+    while not r.at_end():
+        yield load(r)
+
+def file_values(f):
+    with f:
+        for v in load_all(Reader(f.read)):
+            yield v
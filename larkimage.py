@@ -0,0 +1,50 @@
+import types
+import cPickle as pickle
+
+from core import LarkException
+from larkcache import CACHE_VERSION
+
+IMAGE_VERSION = 1
+
+# Objects that belong to the running process rather than to the heap (the
+# interpreter, builtins, run_program, python modules) are written as
+# persistent ids and resolved again against the loading process, so an image
+# never contains functions or module references pickle can't restore.
+
+def save(root, extern_modules, natives, f):
+    ids = {id(v): name for name, v in natives.items()}
+    def persistent_id(obj):
+        name = ids.get(id(obj))
+        if name is not None:
+            return 'native:' + name
+        elif isinstance(obj, types.ModuleType):
+            return 'module:' + obj.__name__
+        return None
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    try:
+        pickler.dump(((IMAGE_VERSION, CACHE_VERSION), root, extern_modules))
+    except (pickle.PicklingError, TypeError) as error:
+        raise LarkException("Cannot save image: {0}".format(error))
+
+def load(natives, f):
+    def persistent_load(pid):
+        kind, name = pid.split(':', 1)
+        if kind == 'native':
+            try:
+                return natives[name]
+            except KeyError:
+                raise LarkException("Image refers to unknown builtin '{0}'.".format(name))
+        module = __import__(name)
+        for part in name.split('.')[1:]:
+            module = getattr(module, part)
+        return module
+    unpickler = pickle.Unpickler(f)
+    unpickler.persistent_load = persistent_load
+    try:
+        version, root, extern_modules = unpickler.load()
+    except (EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError) as error:
+        raise LarkException("Cannot load image: {0}".format(error))
+    if version != (IMAGE_VERSION, CACHE_VERSION):
+        raise LarkException("Image was saved by an incompatible version of lark.")
+    return root, extern_modules
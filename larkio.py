@@ -0,0 +1,110 @@
+import os
+import mmap
+import atexit
+import weakref
+import threading
+
+BUFFER_SIZE = 1 << 20
+
+def read_blocks(read, size=BUFFER_SIZE):
+    while True:
+        block = read(size)
+        if not block:
+            break
+        yield block
+
+# splits large reads into lines instead of calling readline per line
+def read_lines(read, size=BUFFER_SIZE):
+    tail = ''
+    for block in read_blocks(read, size):
+        lines = (tail + block).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+def file_lines(path, size=BUFFER_SIZE):
+    with open(path, 'rb') as f:
+        for line in read_lines(f.read, size):
+            yield line
+
+def stdin_lines(size=BUFFER_SIZE):
+    # os.read returns whatever is available, so interactive input isn't held
+    # back until a whole block has arrived
+    return read_lines(lambda n: os.read(0, n), size)
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return bytearray()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def chunk(data, start, end):
+    d = data[start:end]
+    if isinstance(d, memoryview):
+        return d.tobytes()
+    return d
+
+# yields (start, end) offsets of each line in a memoryview or buffer, only
+# copying one block at a time while scanning for newlines
+def line_spans(data, size=BUFFER_SIZE):
+    n = len(data)
+    start = pos = 0
+    while pos < n:
+        block = chunk(data, pos, pos + size)
+        i = block.find('\n')
+        while i >= 0:
+            yield start, pos + i
+            start = pos + i + 1
+            i = block.find('\n', i + 1)
+        pos += len(block)
+    if start < n:
+        yield start, n
+
+# writers a script never closed are flushed when collected or at exit, so
+# buffered output isn't silently dropped
+open_writers = weakref.WeakSet()
+
+def flush_writers():
+    for w in list(open_writers):
+        w.flush()
+
+atexit.register(flush_writers)
+
+class Writer(object):
+    # collects writes and hands them to the underlying file in large batches;
+    # spawned tasks share their interpreter's writer, so it's locked
+    def __init__(self, f, size=BUFFER_SIZE):
+        self.file = f
+        self.size = size
+        self.parts = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        open_writers.add(self)
+
+    def write(self, s):
+        with self.lock:
+            self.parts.append(s)
+            self.pending += len(s)
+            if self.pending < self.size:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if getattr(self.file, 'closed', False):
+                return
+            if self.parts:
+                self.file.write(''.join(self.parts))
+                self.parts = []
+                self.pending = 0
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        open_writers.discard(self)
+
+    def __del__(self):
+        self.flush()
@@ -4,8 +4,8 @@ from ply import *
 
 keywords = (
     'if', 'then', 'else', 'elif', 'end','as',
-    'namespace','loop','break','continue','return',
-    'true','false','nil','extern','import'
+    'namespace','loop','for','in','break','continue','return',
+    'true','false','nil','extern','import','yield'
 )
 
 tokens = keywords + (
@@ -64,6 +64,7 @@ t_FLOAT          = r'((\d+\.\d+)(E[\+-]?\d+)?|([1-9]\d*E[\+-]?\d+))'
 
 def t_DOCSTRING(t):
     r'''("""(?:[^"]|\\"|"{1,2}(?!"))*""")|(\'\'\'(?:[^']|\\'|'{1,2}(?!'))*\'\'\')'''
+    t.lexer.lineno += t.value.count('\n')
     if t.value.startswith("'"):
         t.value = t.value.strip("'")
     else:
@@ -85,9 +86,15 @@ def t_NEWLINE(t):
     t.value = None
     return t
 
+# "(l<line>,c<column>) <message>" followed by the source line and a caret
+def error_at(data, pos, lineno, message):
+    col = len(data[:pos].rsplit('\n')[-1])
+    lines = data.split('\n')
+    return "(l{0},c{1}) {2}\n{3}\n{4}^".format(lineno, col+1, message, lines[lineno-1], ' '*col)
+
 def t_error(t):
-    raise SyntaxError("Illegal character %s" % t.value[0])
-    t.lexer.skip(1)
+    raise SyntaxError(error_at(t.lexer.lexdata, t.lexpos, t.lexer.lineno,
+        "Illegal character %s" % t.value[0]))
 
 lexer = lex.lex(debug=0)
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+import sys
+import time
+
+from core import ParamVal, Tuple, ListView, DictView
+
+def value_size(v, seen=None):
+    if seen is None:
+        seen = set()
+    if id(v) in seen:
+        return 0
+    seen.add(id(v))
+    size = sys.getsizeof(v)
+    if isinstance(v, (ListView, DictView)):
+        return size + sys.getsizeof(v.obj)
+    elif isinstance(v, Tuple):
+        size += sys.getsizeof(v.data) + sys.getsizeof(v.named)
+        for x in v.data:
+            size += value_size(x, seen)
+        for k, x in v.named.items():
+            size += sys.getsizeof(k) + value_size(x, seen)
+        return size
+    elif isinstance(v, ParamVal):
+        return size
+    return size + sys.getsizeof(getattr(v, 'data', None))
+
+def stats(memory):
+    elapsed = max(time.time() - memory.started, 1e-9)
+    refcounts = {}
+    types = {}
+    for var in memory.slots.values():
+        refcounts[var.refs] = refcounts.get(var.refs, 0) + 1
+        t = types.setdefault(getattr(var.val, 'type', '<ref>'), [0, 0])
+        t[0] += 1
+        t[1] += value_size(var.val)
+    return {
+        'live': len(memory.slots),
+        'allocs': memory.last,
+        'frees': memory.frees,
+        'allocs_per_sec': memory.last / elapsed,
+        'frees_per_sec': memory.frees / elapsed,
+        'refcounts': refcounts,
+        'types': types,
+    }
+
+# slots are grouped by variable name; pvals also by where they were defined,
+# so closures made by the same literal show up together
+def slot_key(var):
+    name = var.name or '<anonymous>'
+    v = var.val
+    if isinstance(v, ParamVal) and v.location is not None:
+        return '{0} ({1}:{2})'.format(name, v.location[0], v.location[1])
+    return name
+
+# {key: [slots, bytes]}
+def snapshot(memory):
+    snap = {}
+    for var in memory.slots.values():
+        s = snap.setdefault(slot_key(var), [0, 0])
+        s[0] += 1
+        s[1] += value_size(var.val)
+    return snap
+
+# [(key, slot delta, byte delta)], largest growth first
+def diff(before, after):
+    out = []
+    for key in set(before) | set(after):
+        b = before.get(key, (0, 0))
+        a = after.get(key, (0, 0))
+        if a[0] != b[0] or a[1] != b[1]:
+            out.append((key, a[0] - b[0], a[1] - b[1]))
+    out.sort(key=lambda d: (d[1], d[2]), reverse=True)
+    return out
+
+def print_report(memory, out=sys.stderr, limit=20):
+    st = stats(memory)
+    out.write('{0} live slots, {1} allocated, {2} freed ({3:.1f} allocs/s, {4:.1f} frees/s)\n'.format(
+        st['live'], st['allocs'], st['frees'], st['allocs_per_sec'], st['frees_per_sec']))
+    out.write('refcounts: {0}\n'.format(', '.join(
+        '{0}: {1}'.format(n, c) for n, c in sorted(st['refcounts'].items()))))
+    out.write('{0:>9} {1:>11}  {2}\n'.format('slots', 'bytes', 'type'))
+    for t, (n, size) in sorted(st['types'].items(), key=lambda kv: kv[1][1], reverse=True):
+        out.write('{0:9d} {1:11d}  {2}\n'.format(n, size, t))
+    out.write('{0:>9} {1:>11}  {2}\n'.format('slots', 'bytes', 'retained by'))
+    rows = sorted(snapshot(memory).items(), key=lambda kv: kv[1][0], reverse=True)
+    for key, (n, size) in rows[:limit]:
+        out.write('{0:9d} {1:11d}  {2}\n'.format(n, size, key))
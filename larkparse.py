@@ -1,4 +1,7 @@
 import sys
+import copy
+import weakref
+from functools import partial
 from ply import *
 
 import larklex
@@ -10,7 +13,7 @@ precedence = (
     ('left', 'PEVAL'),
     ('left', 'EQ', 'GT', 'LT', 'GTE', 'LTE', 'INEQ'),
     ('left', 'PLUS', 'MINUS'),
-    ('left', 'TIMES', 'DIVIDE'),
+    ('left', 'TIMES', 'DIVIDE', 'MOD'),
     # ('right', 'UMINUS'),
     ('right', 'NOT'),
 )
@@ -111,6 +114,7 @@ def p_expression(p):
     '''expression : assignment
                   | conditional_expression
                   | loop_expression
+                  | for_expression
                   | tuple
                   | additive_expression'''
     p[0] = p[1]
@@ -121,18 +125,34 @@ def p_conditional_expression(p):
                               | if_start all else_ifs end
                               | if_start all end''' # should include "then" here?
     if len(p) == 7:
-        p[0] = ('cond-else', p[1], ('group', p[2]), p[3], ('group', p[5]))
+        p[0] = ('cond-else', p[1], group(p, 2), p[3], group(p, 5))
     elif len(p) == 6:
-        p[0] = ('cond-else', p[1], ('group', p[2]), ('group', p[4]))
+        p[0] = ('cond-else', p[1], group(p, 2), group(p, 4))
     elif len(p) == 5:
-        p[0] = ('cond', p[1], ('group', p[2]), p[3])
+        p[0] = ('cond', p[1], group(p, 2), p[3])
     else:
-        p[0] = ('cond', p[1], ('group', p[2]))
+        p[0] = ('cond', p[1], group(p, 2))
+
+def group(p, n):
+    node = ('group', p[n])
+    mark(p, node, n)
+    return node
 
 def p_loop_expression(p):
     '''loop_expression : loop expression all end'''
     p[0] = ('loop', p[2], p[3])
 
+def p_for_expression(p):
+    '''for_expression : for_start all end'''
+    p[0] = ('for', p[1][0], p[1][1], p[2])
+
+# the loop variable is a local of the enclosing body, so it's defined before
+# the body is reduced
+def p_for_start(p):
+    '''for_start : for ID in expression'''
+    p.parser.defs[-1].add(p[2])
+    p[0] = (p[2], p[4])
+
 def p_break_statement(p):
     '''expression : break'''
     p[0] = ('break',)
@@ -145,6 +165,11 @@ def p_return_statement(p):
     else:
         p[0] = ('return', nil)
 
+def p_yield_statement(p):
+    '''expression : yield expression'''
+    p.parser.gens[-1] = True
+    p[0] = ('yield', p[2])
+
 def p_continue_statement(p):
     '''expression : continue'''
     p[0] = ('continue',)
@@ -158,9 +183,9 @@ def p_else_ifs(p):
     '''else_ifs : else_ifs elif expression all
                 | elif expression all'''
     if len(p) == 6:
-        p[0] = p[1] + [(p[3], ('group', p[4]))]
+        p[0] = p[1] + [(p[3], group(p, 4))]
     else:
-        p[0] = [(p[2], ('group', p[3]))]
+        p[0] = [(p[2], group(p, 3))]
 
 def p_additive_expression(p):
     '''additive_expression : expression PLUS expression
@@ -221,6 +246,9 @@ def p_param_val(p):
     else:
         p[0] = ('pval', p[2], p[6], list(p.parser.refs.pop()))
     p.parser.defs.pop()
+    if p.parser.gens.pop():
+        mark(p, p[0])
+        p[0] = ('generator', p[0])
 
 def p_dot_op(p):
     '''dot_op : primary_expression DOT LPAREN expression RPAREN
@@ -241,6 +269,7 @@ def p_clear_defs(p):
     '''clear_defs :'''
     p.parser.refs.append(set())
     p.parser.defs.append(set())
+    p.parser.gens.append(False)
 
 def p_parameters(p):
     '''parameters : parameters tuple_sep expression
@@ -291,9 +320,12 @@ def p_param_definition(p):
 
 def p_evaluation(p):
     '''evaluation : primary_expression param_open parameters param_close %prec PEVAL
+                  | primary_expression param_open param_close %prec PEVAL
                   | identifier'''
     if len(p) == 5:
         p[0] = ('param-eval', p[1], p[3])
+    elif len(p) == 4:
+        p[0] = ('param-eval', p[1], [])
     else:
         if '::' in p[1] or p[1] not in p.parser.defs[-1]:
             p.parser.refs[-1].add(p[1])
@@ -395,24 +427,141 @@ def p_nilval(p):
     '''nilval : nil'''
     p[0] = nil
 
+# the parser doesn't pass p_error the input at the end, so parse_with adds
+# the position
+class UnexpectedEnd(SyntaxError): pass
+
 def p_error(p):
-    lines = p.lexer.lexdata.split('\n')
-    col = len(p.lexer.lexdata[:p.lexpos].rsplit('\n')[-1])
-    line = "(l{0},c{1}) unexpected token {2}\n{3}\n{4}^".format(
-            p.lineno, col+1, p.type, lines[p.lineno-1], ' '*col)
-    raise SyntaxError(line)
+    if p is None:
+        raise UnexpectedEnd("unexpected end of input")
+    raise SyntaxError(larklex.error_at(p.lexer.lexdata, p.lexpos, p.lineno,
+        "unexpected token {0}".format(p.type)))
 
 parser = yacc.yacc()
 
-def parse(data, debug=0):
-    larklex.lexer.lineno = 1
+# Source positions of parsed nodes, kept in a side table so the node tuples
+# keep their layout:
+#   (filename, line, column, end line, end column)
+# where the end is the start of the node's last token. Each parsed program
+# has its own table, which holds its nodes, so a node id is never reused
+# while its entry exists. index maps a node id to a weak reference to its
+# table, and a table's entries leave the index when it's collected.
+index = {}
+
+def forget(ref, ids):
+    for i in ids:
+        if index.get(i) is ref:
+            del index[i]
+
+class SpanTable(object):
+    def __init__(self, pairs=(), filename=None):
+        self.nodes = {}
+        self.ids = []
+        self.ref = weakref.ref(self, partial(forget, ids=self.ids))
+        self.add(pairs, filename)
+
+    def add(self, pairs, filename=None):
+        nodes, ids, ref = self.nodes, self.ids, self.ref
+        for node, span in pairs:
+            if filename is not None:
+                span = (filename,) + tuple(span[1:])
+            nodes[id(node)] = (node, span)
+            ids.append(id(node))
+            index[id(node)] = ref
+
+    def pairs(self):
+        return self.nodes.values()
+
+    # pickled with the AST it covers, e.g. in images, and indexed again
+    def __getstate__(self):
+        return self.pairs()
+
+    def __setstate__(self, pairs):
+        self.__init__(pairs)
+
+# (span, table) for a node, or (None, None) if it isn't in a live table
+def lookup(node):
+    ref = index.get(id(node))
+    table = ref() if ref is not None else None
+    if table is not None:
+        entry = table.nodes.get(id(node))
+        if entry is not None and entry[0] is node:
+            return entry[1], table
+    return None, None
+
+def span_of(node):
+    return lookup(node)[0]
+
+class Prog(list):
+    # a parsed program: its statements, plus the span table for its nodes
+    spans = None
+
+def with_spans(prog, pairs, filename=None):
+    prog = Prog(prog)
+    prog.spans = SpanTable(pairs, filename)
+    return prog
+
+def mark(p, node, n=0):
+    start, end = p.lexspan(n)
+    p.parser.spans.append((node, (p.lineno(n), start, p.linespan(n)[1], end)))
+
+# nil, true and false are shared, so they can't carry a position
+def trackable(node):
+    return isinstance(node, tuple) or (isinstance(node, Val)
+            and node is not nil and node is not true and node is not false)
+
+def track(fn):
+    def tracked(p):
+        fn(p)
+        if trackable(p[0]):
+            mark(p, p[0])
+    return tracked
+
+# wrapping the bound callables leaves production order, and so conflict
+# resolution, untouched
+for prod in parser.productions:
+    if prod.callable is not None:
+        prod.callable = track(prod.callable)
+
+def column(data, pos):
+    return pos - data.rfind('\n', 0, pos)
+
+def parse_with(parser, lexer, data, debug=0, filename='<string>'):
+    lexer.lineno = 1
     parser.error = 0
     parser.refs = [set()]
     parser.defs = [set()]
-    p = parser.parse(data, lexer=larklex.lexer, debug=debug)
+    parser.gens = [False]
+    parser.spans = []
+    try:
+        p = parser.parse(data, lexer=lexer, debug=debug, tracking=True)
+    except UnexpectedEnd as error:
+        end = len(data.rstrip())
+        raise SyntaxError(larklex.error_at(data, end, data.count('\n', 0, end) + 1, error.message))
+    # a node passed up through several rules keeps its innermost span
+    seen = set()
+    pairs = []
+    for node, (line, start, endline, end) in parser.spans:
+        if id(node) not in seen:
+            seen.add(id(node))
+            pairs.append((node, (filename, line, column(data, start), endline, column(data, end))))
     if parser.error:
         return None
-    return p
+    return with_spans(p, pairs)
+
+# uses the module-level parser and lexer; not safe to call from several
+# threads at once, use a Parser per thread for that
+def parse(data, debug=0, filename='<string>'):
+    return parse_with(parser, larklex.lexer, data, debug, filename)
+
+class Parser(object):
+    # private lexer and parser state over the shared parse tables
+    def __init__(self):
+        self.parser = copy.copy(parser)
+        self.lexer = larklex.lexer.clone()
+
+    def parse(self, data, debug=0, filename='<string>'):
+        return parse_with(self.parser, self.lexer, data, debug, filename)
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
@@ -0,0 +1,193 @@
+import sys
+import time
+import marshal
+import threading
+
+from core import ParamVal, Builtin
+from larkparse import span_of
+from larkspec import node_codes
+
+timer = time.time
+
+def func_key(pv):
+    name = pv.name or '<anonymous>'
+    if isinstance(pv, Builtin):
+        return ('~', 0, '<builtin {0}>'.format(name))
+    if pv.location is None:
+        return ('<unknown>', 0, name)
+    return (pv.location[0], pv.location[1], name)
+
+class FuncStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.primitive = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.allocs = 0
+        self.own_allocs = 0
+        self.callers = {}
+
+class Profiler(object):
+    # Deterministic per-pval profiler. While enabled, ParamVal and Builtin
+    # calls (and Caller's ParamVal.run_in) go through a timing wrapper; disabled, the original __call__
+    # methods are restored, so there is no cost when not profiling.
+    def __init__(self, memory):
+        self.memory = memory
+        self.stats = {}
+        self.local = threading.local()
+        self.saved = None
+
+    def enable(self):
+        if self.saved is not None:
+            return
+        self.saved = (ParamVal.__call__, ParamVal.run_in, Builtin.__call__)
+        ParamVal.__call__ = self.wrap(self.saved[0])
+        ParamVal.run_in = self.wrap(self.saved[1])
+        Builtin.__call__ = self.wrap(self.saved[2])
+
+    def disable(self):
+        if self.saved is None:
+            return
+        ParamVal.__call__, ParamVal.run_in, Builtin.__call__ = self.saved
+        self.saved = None
+
+    def wrap(self, call):
+        profiler = self
+        def profiled(pv, *args):
+            return profiler.call(call, pv, args)
+        return profiled
+
+    def call(self, call, pv, args):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+            self.local.depth = {}
+        depth = self.local.depth
+        key = func_key(pv)
+        depth[key] = depth.get(key, 0) + 1
+        # frame: key, start time, child time, start allocs, child allocs
+        frame = [key, timer(), 0.0, self.memory.last, 0]
+        stack.append(frame)
+        try:
+            return call(pv, *args)
+        finally:
+            stack.pop()
+            depth[key] -= 1
+            elapsed = timer() - frame[1]
+            allocs = self.memory.last - frame[3]
+            st = self.stats.get(key)
+            if st is None:
+                st = self.stats[key] = FuncStats()
+            st.calls += 1
+            st.exclusive += elapsed - frame[2]
+            st.own_allocs += allocs - frame[4]
+            # recursive calls are already covered by the outermost one
+            if depth[key] == 0:
+                st.primitive += 1
+                st.inclusive += elapsed
+                st.allocs += allocs
+            caller = stack[-1][0] if stack else ('~', 0, '<toplevel>')
+            c = st.callers.get(caller, [0, 0, 0.0, 0.0])
+            c[0] += 1
+            c[1] += 1
+            c[2] += elapsed - frame[2]
+            c[3] += elapsed
+            st.callers[caller] = c
+            if stack:
+                stack[-1][2] += elapsed
+                stack[-1][4] += allocs
+
+    def print_stats(self, out=sys.stderr, limit=None):
+        rows = sorted(self.stats.items(), key=lambda kv: kv[1].inclusive, reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        out.write('{0:>9} {1:>9} {2:>11} {3:>11} {4:>10} {5:>10}  {6}\n'.format(
+            'calls', 'primitive', 'inclusive', 'exclusive', 'allocs', 'own allocs', 'pval'))
+        for (filename, line, name), st in rows:
+            out.write('{0:9d} {1:9d} {2:11.6f} {3:11.6f} {4:10d} {5:10d}  {6} ({7}:{8})\n'.format(
+                st.calls, st.primitive, st.inclusive, st.exclusive,
+                st.allocs, st.own_allocs, name, filename, line))
+
+    # writes the marshalled dict pstats.Stats loads:
+    # {func: (primitive calls, calls, exclusive, inclusive, callers)}
+    def dump_stats(self, path):
+        out = {}
+        for key, st in self.stats.items():
+            callers = {k: tuple(v) for k, v in st.callers.items()}
+            out[key] = (st.primitive, st.calls, st.exclusive, st.inclusive, callers)
+        with open(path, 'wb') as f:
+            marshal.dump(out, f)
+
+# taken before a Profiler can swap the methods out
+call_codes = (ParamVal.__call__.im_func.func_code, ParamVal.run_in.im_func.func_code,
+        Builtin.__call__.im_func.func_code)
+
+def frame_label(name, span):
+    if span is None:
+        return name
+    return '{0} ({1}:{2})'.format(name, span[0], span[1])
+
+class Sampler(object):
+    # Low-overhead sampling profiler. A background thread periodically looks
+    # at the python stacks of the other threads, rebuilds the lark call stack
+    # from the evaluate, compiled body and pval call frames on them, and
+    # counts each stack with the line currently running in every pval.
+    def __init__(self, evaluate, interval=0.005):
+        self.eval_code = evaluate.func_code
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        me = threading.current_thread().ident
+        while self.running:
+            time.sleep(self.interval)
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.sample(frame)
+
+    def sample(self, frame):
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        stack = [['<toplevel>', None]]
+        running = False
+        for f in reversed(frames):
+            if f.f_code is self.eval_code:
+                running = True
+                span = span_of(f.f_locals.get('expr'))
+                if span is not None:
+                    stack[-1][1] = span
+            elif f.f_code in node_codes:
+                span = span_of(f.f_locals.get('at'))
+                if span is not None:
+                    stack[-1][1] = span
+            elif f.f_code in call_codes:
+                pv = f.f_locals.get('self')
+                stack.append([getattr(pv, 'name', None) or '<anonymous>', getattr(pv, 'location', None)])
+        if not running:
+            return
+        key = ';'.join(frame_label(name, span) for name, span in stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    # one "frame;frame;frame count" line per distinct stack, the folded
+    # format flamegraph.pl and speedscope read
+    def write_folded(self, out):
+        for key, n in sorted(self.counts.items()):
+            out.write('{0} {1}\n'.format(key, n))
@@ -0,0 +1,135 @@
+import os
+import json
+import signal
+import socket
+import threading
+import traceback
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from core import LarkException, Tuple, as_lark, as_py
+
+# JSON-lines request/response server. A request is an object with either
+# "path" (a lark file) or "source", plus optional "id" and "inputs" (names
+# bound in the request's scope); the response carries the same id, "ok", and
+# either "result" and "output" or "error".
+
+def json_value(v):
+    if isinstance(v, Tuple) and v.named and v.data:
+        return [json_value(x) for x in v.iterate()] + [
+                {k: json_value(x) for k, x in v.named.items()}]
+    try:
+        py = as_py(v)
+        json.dumps(py)
+        return py
+    except (TypeError, ValueError):
+        return str(v)
+
+def exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+class Server(object):
+    def __init__(self, interp, workers=1):
+        self.interp = interp
+        self.workers = workers
+        self.progs = {}
+        self.lock = threading.Lock()
+
+    def parse(self, child, source):
+        prog = self.progs.get(source)
+        if prog is None:
+            if len(self.progs) >= 1024:
+                self.progs.clear()
+            prog = self.progs[source] = child.parse(source)
+        return prog
+
+    def handle(self, request):
+        response = {'id': request.get('id')}
+        out = StringIO()
+        child = type(self.interp)(out=out, parent=self.interp)
+        try:
+            for name, value in (request.get('inputs') or {}).items():
+                child.root.new_assign(name, as_lark(value))
+            if 'path' in request:
+                result = child.run_file(request['path'])
+            elif 'source' in request:
+                result = child.execute(self.parse(child, request['source']))
+            else:
+                raise LarkException("Request needs a 'path' or 'source'.")
+            response['ok'] = True
+            response['result'] = json_value(result)
+        except LarkException as error:
+            response['ok'] = False
+            response['error'] = '{0}: {1}'.format(type(error).__name__, error)
+        except Exception as error:
+            response['ok'] = False
+            response['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+        finally:
+            child.close()
+        response['output'] = out.getvalue()
+        return response
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return {'id': None, 'ok': False, 'error': 'Bad request: {0}'.format(error)}
+        if not isinstance(request, dict):
+            return {'id': None, 'ok': False, 'error': 'Bad request: expected an object'}
+        return self.handle(request)
+
+    # responses are written as they finish, so with several workers they may
+    # come back out of order; match them up by id
+    def serve_lines(self, infile, outfile):
+        pool = ThreadPool(self.workers)
+        def reply(response):
+            with self.lock:
+                outfile.write(json.dumps(response) + '\n')
+                outfile.flush()
+        try:
+            for line in iter(infile.readline, ''):
+                if line.strip():
+                    pool.apply_async(self.handle_line, (line,), callback=reply)
+        finally:
+            pool.close()
+            pool.join()
+
+    # each connection is a JSON-lines stream answered in order; up to
+    # workers connections are served at once
+    def serve_socket(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(64)
+        pool = ThreadPool(self.workers)
+        # SIGTERM would otherwise end the process without running the
+        # cleanup below, leaving the socket file behind
+        # (signal handlers can only be set from the main thread)
+        main = isinstance(threading.current_thread(), threading._MainThread)
+        if main:
+            previous = signal.signal(signal.SIGTERM, exit_on_signal)
+        try:
+            while True:
+                conn, _ = listener.accept()
+                pool.apply_async(self.serve_connection, (conn,))
+        finally:
+            if main:
+                signal.signal(signal.SIGTERM, previous or signal.SIG_DFL)
+            pool.terminate()
+            listener.close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def serve_connection(self, conn):
+        f = conn.makefile('rwb')
+        try:
+            for line in iter(f.readline, ''):
+                if line.strip():
+                    f.write(json.dumps(self.handle_line(line)) + '\n')
+                    f.flush()
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            conn.close()
@@ -0,0 +1,314 @@
+import types
+import weakref
+import operator
+
+from core import Val, Tuple, LarkException, LarkReturn, nil, true, false
+
+# calls observed before a pval is specialized, and how many guard failures
+# it tolerates before going back to the generic body
+SPECIALIZE_AFTER = 50
+MAX_DEOPTS = 20
+
+arith = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div,
+    '%': operator.mod,
+}
+comparisons = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+numeric = ('int', 'float')
+
+def signature(args):
+    return tuple((a.__class__, a.type) for a in args)
+
+def format_signature(sig):
+    return ','.join(t for cls, t in sig)
+
+# names whose slots the body (or a closure made in it) might rebind
+def assigned_names(node, out):
+    if isinstance(node, list):
+        for x in node:
+            assigned_names(x, out)
+    elif isinstance(node, tuple) and node and isinstance(node[0], str):
+        t = node[0]
+        if t in ('assign', 'upval-assign', 'for'):
+            out.add(node[1])
+        elif t == 'ref':
+            out.update(x for x in node[1:] if isinstance(x, str))
+        elif t == 'op-assign' and isinstance(node[2], str):
+            out.add(node[2])
+        for x in node[1:]:
+            if isinstance(x, (tuple, list)):
+                assigned_names(x, out)
+    elif isinstance(node, tuple):
+        for x in node:
+            assigned_names(x, out)
+    return out
+
+def slot_value(name):
+    def fn(env):
+        return env.memory.slots[env.vars[name].addr].val
+    return fn
+
+def slot_data(name):
+    def fn(env):
+        return env.memory.slots[env.vars[name].addr].val.data
+    return fn
+
+class Compiler(object):
+    # Turns a pval body into nested python closures for one argument type
+    # signature. Parameters the body never rebinds keep their observed type,
+    # so arithmetic and comparisons on them are resolved here, once, and run
+    # on unboxed python numbers; anything the compiler doesn't know about is
+    # handed to the generic evaluate.
+    def __init__(self, evaluate, binary_expr, binary_ops, params, sig, prog):
+        self.evaluate = evaluate
+        self.binary_expr = binary_expr
+        self.binary_ops = binary_ops
+        rebound = assigned_names(prog, set())
+        self.types = {}
+        for p, (cls, t) in zip(params, sig):
+            if p[1] not in rebound:
+                self.types[p[1]] = (cls, t)
+
+    def generic(self, node):
+        evaluate = self.evaluate
+        return lambda env: evaluate(node, env)
+
+    def static_type(self, node):
+        if isinstance(node, Val):
+            return node.type
+        elif node[0] == 'evaluation' and node[1] in self.types:
+            return self.types[node[1]][1]
+        return None
+
+    # (fn returning a raw python number or bool, lark type), or None
+    def unboxed(self, node):
+        if isinstance(node, Val):
+            if node.type in numeric or node.type == 'bool':
+                c = node.data
+                return (lambda env: c), node.type
+            return None
+        t = node[0]
+        if t == 'evaluation' and node[1] in self.types:
+            vt = self.types[node[1]][1]
+            if vt in numeric or vt == 'bool':
+                return slot_data(node[1]), vt
+        elif t == 'binary':
+            op = node[1]
+            l = self.unboxed(node[2])
+            r = self.unboxed(node[3])
+            if l is None or r is None:
+                return None
+            (lf, lt), (rf, rt) = l, r
+            if op in arith and lt in numeric and rt in numeric:
+                fn = arith[op]
+                out = 'int' if lt == rt == 'int' else 'float'
+                return (lambda env: fn(lf(env), rf(env))), out
+            elif op in comparisons and (lt in numeric and rt in numeric or op in ('==', '!=')):
+                fn = comparisons[op]
+                return (lambda env: fn(lf(env), rf(env))), 'bool'
+        elif t == 'unary':
+            v = self.unboxed(node[2])
+            if v is None:
+                return None
+            vf, vt = v
+            if node[1] == '-' and vt in numeric:
+                return (lambda env: -vf(env)), vt
+            elif node[1] == '!' and vt == 'bool':
+                return (lambda env: not vf(env)), 'bool'
+        return None
+
+    def boxed(self, node):
+        if isinstance(node, Val):
+            return lambda env: node
+        if not isinstance(node, tuple):
+            return self.generic(node)
+        u = self.unboxed(node)
+        if u is not None:
+            fn, t = u
+            if t == 'bool':
+                return lambda env: true if fn(env) else false
+            return lambda env: Val(t, fn(env))
+        t = node[0]
+        if t == 'evaluation' and node[1] in self.types:
+            # plain values return themselves when evaluated; pvals, builtins
+            # and python callables would be called
+            if self.types[node[1]][0].__call__ == Val.__call__:
+                return slot_value(node[1])
+        elif t == 'dot' and not isinstance(node[1], Val) and node[1][0] == 'evaluation' \
+                and self.types.get(node[1][1], (None,))[0] is Tuple:
+            return self.tuple_member(slot_value(node[1][1]), node[2])
+        elif t == 'binary':
+            return self.binary(node)
+        elif t == 'param-eval':
+            return self.call(node)
+        elif t == 'group':
+            return self.block(node[1])
+        elif t in ('cond', 'cond-else'):
+            return self.cond(node)
+        return self.generic(node)
+
+    def tuple_member(self, get, a):
+        if isinstance(a, int):
+            def fn(env):
+                try:
+                    return get(env).data[a]
+                except IndexError:
+                    raise LarkException("Dot-access index for tuple is out of range: {0}".format(a))
+            return fn
+        elif isinstance(a, basestring):
+            def fn(env):
+                try:
+                    return get(env).named[a]
+                except KeyError:
+                    raise LarkException("Dot-access member '{0}' not in tuple".format(a))
+            return fn
+        return lambda env: get(env).getmember(a)
+
+    def binary(self, node):
+        op = node[1]
+        l = self.boxed(node[2])
+        r = self.boxed(node[3])
+        lt = self.static_type(node[2])
+        rt = self.static_type(node[3])
+        handler = self.binary_ops.get((op, lt, rt))
+        if handler is not None:
+            return lambda env: handler(l(env), r(env))
+        binary_expr = self.binary_expr
+        return lambda env: binary_expr(op, l(env), r(env), env)
+
+    def call(self, node):
+        p = node[1]
+        if not isinstance(p, Val) and p[0] == 'evaluation':
+            name = p[1]
+            callee = lambda env: env.retrieve_val(env.getref(name))
+        else:
+            callee = self.boxed(p)
+        args = [self.boxed(a) for a in node[2]]
+        def fn(env):
+            at = node
+            v = callee(env)
+            try:
+                return v(*[a(env) for a in args])
+            except LarkReturn as e:
+                return e.value
+        return fn
+
+    def condition(self, node):
+        u = self.unboxed(node)
+        if u is not None and u[1] == 'bool':
+            return u[0]
+        c = self.boxed(node)
+        return lambda env: c(env) == true
+
+    def cond(self, node):
+        branches = [(node[1], self.condition(node[1]), node[2], self.boxed(node[2]))]
+        has_else = node[0] == 'cond-else'
+        if len(node) > (4 if has_else else 3):
+            branches += [(c, self.condition(c), b, self.boxed(b)) for c, b in node[3]]
+        last = node[-1] if has_else else None
+        otherwise = self.boxed(last) if has_else else (lambda env: nil)
+        def fn(env):
+            for at, c, body, b in branches:
+                if c(env):
+                    at = body
+                    return b(env)
+            at = last
+            return otherwise(env)
+        return fn
+
+    def block(self, prog):
+        stmts = [(x, self.boxed(x)) for x in prog if x]
+        if len(stmts) == 1:
+            return stmts[0][1]
+        def fn(env):
+            last = nil
+            for at, s in stmts:
+                last = s(env)
+            return last
+        return fn
+
+# compiled closures keep the node they are running in their 'at' local, where
+# the sampler reads it since these bodies never go through evaluate
+node_codes = tuple(c for m in (Compiler.call, Compiler.cond, Compiler.block)
+        for c in m.im_func.func_code.co_consts
+        if isinstance(c, types.CodeType) and 'at' in c.co_varnames)
+
+class Specialization(object):
+    def __init__(self, sig, body):
+        self.sig = sig
+        self.body = body
+        self.hits = 0
+        self.deopts = 0
+
+class Specializer(object):
+    # ParamVal.__call__ asks select for the body to run. A pval's first calls
+    # record their argument type signatures; once it is hot, the most common
+    # signature gets a compiled body, guarded by a signature check on every
+    # call. Calls failing the guard deoptimize to the generic body, and a pval
+    # that keeps failing drops its specialization and starts observing again.
+    def __init__(self, evaluate, binary_expr, binary_ops):
+        self.evaluate = evaluate
+        self.binary_expr = binary_expr
+        self.binary_ops = binary_ops
+        self.specialized = 0
+        self.deopts = 0
+        self.despecialized = 0
+        self.pvals = weakref.WeakValueDictionary()
+
+    def select(self, pv, args):
+        spec = pv.spec
+        if spec is not None:
+            if signature(args) == spec.sig:
+                spec.hits += 1
+                return spec.body
+            spec.deopts += 1
+            self.deopts += 1
+            if spec.deopts > MAX_DEOPTS and spec.deopts > spec.hits:
+                pv.spec = None
+                pv.observed = {}
+                self.despecialized += 1
+            return pv.data
+        observed = pv.observed
+        if observed is None:
+            if pv.prog is None or pv.generator or any(p[0] != 'param' for p in pv.params):
+                pv.observed = False
+                return pv.data
+            observed = pv.observed = {}
+        elif observed is False:
+            return pv.data
+        sig = signature(args)
+        observed[sig] = observed.get(sig, 0) + 1
+        if sum(observed.values()) >= SPECIALIZE_AFTER:
+            sig = max(observed, key=observed.get)
+            pv.observed = None
+            pv.spec = self.compile(pv, sig)
+            self.specialized += 1
+            self.pvals[id(pv)] = pv
+        return pv.data
+
+    def compile(self, pv, sig):
+        c = Compiler(self.evaluate, self.binary_expr, self.binary_ops, pv.params, sig, pv.prog)
+        return Specialization(sig, c.block(pv.prog))
+
+    def stats(self):
+        rows = []
+        for pv in self.pvals.values():
+            if pv.spec is not None:
+                rows.append((pv.name or '<anonymous>', format_signature(pv.spec.sig),
+                    pv.calls, pv.spec.hits, pv.spec.deopts))
+        return {
+            'specialized': self.specialized,
+            'deopts': self.deopts,
+            'despecialized': self.despecialized,
+            'pvals': sorted(rows),
+        }